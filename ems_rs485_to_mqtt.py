@@ -6,10 +6,25 @@ import serial
 import time
 import struct
 import paho.mqtt.client as mqtt
-from datetime import datetime
 import threading
 import logging
+import logging.handlers
 import queue
+import sys
+import os
+import asyncio
+import json
+import http.server
+import cProfile
+import random
+import signal
+from collections import namedtuple, OrderedDict
+
+# Optional: kompilierte CRC-Berechnung (pip install crcmod)
+try:
+    import crcmod.predefined
+except ImportError:
+    crcmod = None
 
 ################################################################################
 #                                   Variablen                                  #
@@ -18,17 +33,40 @@ import queue
 device_address = 0x01
 EMS_Nr = "0001";
 
+# Mehrere EMS an einem RS485-Bus: Geräteadresse und EMS-Nummer je Gerät
+EMS_DEVICES = [
+    (device_address, EMS_Nr),
+]
+EMS_BUS_REPORT_INTERVAL = 60
+
+# Wiederholungen je Anfrage mit exponentiell wachsender Wartezeit je EMS (Sekunden) und Ausfallerkennung:
+# Nach EMS_OFFLINE_AFTER fehlgeschlagenen Anfragen in Folge gilt ein EMS als offline und wird nur noch
+# alle EMS_OFFLINE_PROBE_INTERVAL Sekunden mit einer einzelnen Anfrage geprüft.
+EMS_MAX_RETRIES = 2
+EMS_RETRY_BACKOFF = 0.05
+EMS_RETRY_BACKOFF_MAX = 1
+EMS_OFFLINE_AFTER = 3
+EMS_OFFLINE_PROBE_INTERVAL = 30
+
+# Schreibbefehle entfallen, wenn das Register laut einer höchstens so alten Abfrage (Sekunden) bereits den Wert hat
+EMS_WRITE_SKIP_MAX_AGE = 120
+
+# Warmstart: Datei für die zuletzt gelesenen Registerwerte (None = aus) und Intervall, in dem sie gesichert werden (Sekunden)
+EMS_STATE_FILE = "/home/pi/ems_mqtt/registers.json"
+EMS_STATE_SAVE_INTERVAL = 300
+
+# Metriken: HTTP-Port für Prometheus/OpenMetrics (0 = aus) und Grenzen der Antwortzeit-Histogramme in Sekunden
+METRICS_PORT = 0
+METRICS_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 1, 2)
+
+# Laufzeitmessung: Zeiten je Verarbeitungsschritt protokollieren und optional cProfile-Daten je Thread schreiben
+PROFILE_STAGES = False
+PROFILE_REPORT_INTERVAL = 60
+PROFILE_OUTPUT = None
+
 # Logging
 LOG_LEVEL = logging.INFO
 LOG_FILE = "/home/pi/ems_mqtt/your_script_name.log"
-LOG_LEVEL_NAMES = {
-    logging.NOTSET: 'NOTSET',
-    logging.DEBUG: 'DEBUG',
-    logging.INFO: 'INFO',
-    logging.WARNING: 'WARNING',
-    logging.ERROR: 'ERROR',
-    logging.CRITICAL: 'CRITICAL'
-}
 
 # RS485
 RS485_PORT = "/dev/ttyUSB0"
@@ -36,22 +74,129 @@ RS485_BAUD_RATE = 9600
 RS485_PARITY = serial.PARITY_NONE
 RS485_STOPBITS = serial.STOPBITS_ONE
 RS485_BYTESIZE = serial.EIGHTBITS
+RS485_TIMEOUT = 1
+RS485_INTER_BYTE_CHARS = 3.5
+RS485_INTER_BYTE_MIN_TIMEOUT = 0.02
+RS485_REOPEN_DELAY = 10
+
+# Mehrere RS485-Adapter: serieller Port und die daran angeschlossenen EMS
+RS485_BUSES = {
+    RS485_PORT: EMS_DEVICES,
+}
 
 # MQTT
 MQTT_BROKER = "192.168.178.123"
 MQTT_PORT = 1883
 MQTT_USERNAME = "mqtt"
 MQTT_PASSWORD = "12345"
+MQTT_MAX_INFLIGHT = 20
+MQTT_MAX_QUEUED = 0
+MQTT_PUBLISH_RATE = 0
+MQTT_PUBLISH_BURST = 50
+MQTT_PUBLISH_BATCH_SIZE = 50
+MQTT_PUBLISH_WAIT_TIMEOUT = 60
+MQTT_QUEUE_REPORT_INTERVAL = 60
+
+# Verbindungsabbruch: erneute Verbindung im Hintergrund mit exponentiell wachsender, zufällig gestreuter Wartezeit (Sekunden)
+MQTT_RECONNECT_DELAY = 1
+MQTT_RECONNECT_DELAY_MAX = 60
+
+# Zwischenspeicher während eines Broker-Ausfalls: Verzeichnis (None = aus), Größe je Datei und insgesamt in Bytes
+# sowie die Rate (Registerblöcke pro Sekunde), mit der nach der Wiederverbindung nachgesendet wird
+MQTT_SPOOL_DIR = None
+MQTT_SPOOL_SEGMENT_SIZE = 1024 * 1024
+MQTT_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+MQTT_SPOOL_REPLAY_RATE = 20
+
+# Veröffentlichung: "topics" (ein Topic je Register) oder "json" (ein JSON-Dokument je Registerblock)
+MQTT_PUBLISH_MODE = "topics"
+
+# Nur Änderungen veröffentlichen
+MQTT_PUBLISH_CHANGES_ONLY = True
+MQTT_HEARTBEAT_INTERVAL = 300
+MQTT_DEADBANDS = {
+    "EM_Total_Power": 1,
+}
 
-# EMS Steuerung
-EMS_EM_FLG = False
-EMS_EM_Value = 0x0000
+# Laufzeit: "threads" (ein Thread je Aufgabe) oder "asyncio" (alle Aufgaben in einer Ereignisschleife)
+RUNTIME_MODE = "threads"
 
-EMS_Bypass_FLG = False
-EMS_Bypass_Value = 0x0000
+# EMS Abfragen
+# Startadresse, Anzahl Register, Abfrageintervall in Sekunden, Beschreibung
+EMS_POLL_BLOCKS = [
+    (0x403A, 0x0014, 1,  "Batterie & CT Informationen"),
+    (0x4001, 0x0014, 2,  "Temperatur und MPPT Informationen"),
+    (0x4022, 0x0014, 5,  "CT Informationen"),
+    (0x4016, 0x0014, 5,  "Batterie & EMS Informationen"),
+    (0x301F, 0x0014, 60, "Batterie Einstellungen"),
+    (0x302D, 0x0014, 60, "EMS Einstellungen"),
+]
 
-EMS_Power_Limit_FLG = False
-EMS_Power_Limit_Value = 0x0000
+# Zusammenfassen der Abfragen: höchstens so viele Register je Anfrage und Kosten einer zusätzlichen Anfrage
+# in Byte-Zeiten (Anfrage, Antwortkopf und Antwortverzögerung), gegen die mitgelesene ungenutzte Register abgewogen werden
+EMS_MAX_REGISTER_COUNT = 0x0014
+EMS_REQUEST_OVERHEAD = 40
+
+################################################################################
+#                               Registerzuordnung                              #
+################################################################################
+# Jeder Eintrag beschreibt ein veröffentlichtes EMS-Register:
+# Adresse, Topic-Name, Breite (Anzahl 16-Bit-Register), vorzeichenbehaftet, Teiler, Texte.
+# Bei Texten steht der Schlüssel None für alle nicht aufgeführten Werte.
+# Ein neues Register der EMS-Firmware benötigt nur einen weiteren Eintrag.
+SWITCH_LABELS = {1: "on", None: "off"}
+ONLINE_LABELS = {1: "Online", None: "Offline"}
+
+EMS_REGISTERS = [
+    (0x302D, "EMS_Limit",                    1, False, 1,   SWITCH_LABELS),
+    (0x302E, "EMS_Power_Limit",              1, False, 1,   None),
+    (0x4021, "EMS_Load_Power",               1, False, 10,  None),
+    (0x303B, "EMS_EM",                       1, False, 1,   SWITCH_LABELS),
+    (0x3039, "EMS_Bypass",                   1, False, 1,   SWITCH_LABELS),
+    (0x4001, "EMS_Temperature",              1, False, 10,  None),
+    (0x401F, "EMS_Load_Energy",              1, False, 10,  None),
+    (0x3072, "EMS_Address",                  1, False, 1,   None),
+    (0x4002, "MPPT1_Voltage",                1, False, 10,  None),
+    (0x4003, "MPPT1_Current",                1, False, 100, None),
+    (0x4004, "MPPT1_Power",                  1, False, 1,   None),
+    (0x400E, "MPPT1_Energy",                 2, False, 10,  None),
+    (0x4005, "MPPT2_Voltage",                1, False, 10,  None),
+    (0x4006, "MPPT2_Current",                1, False, 100, None),
+    (0x4007, "MPPT2_Power",                  1, False, 1,   None),
+    (0x4010, "MPPT2_Energy",                 2, False, 10,  None),
+    (0x401E, "MPPT_Total_Energy",            1, False, 10,  None),
+    (0x4016, "Battery_Online",               1, False, 1,   ONLINE_LABELS),
+    (0x4042, "Battery_BMS_Online",           1, False, 1,   ONLINE_LABELS),
+    (0x401D, "Battery_SOC",                  1, False, 1,   None),
+    (0x4018, "Battery_Voltage",              1, False, 10,  None),
+    (0x401A, "Battery_Charging_Power",       1, False, 10,  None),
+    (0x4019, "Battery_Charging_Current",     1, False, 100, None),
+    (0x401C, "Battery_Discharging_Power",    1, False, 10,  None),
+    (0x401B, "Battery_Discharging_Current",  1, False, 100, None),
+    (0x4017, "Battery_Temperature",          1, False, 10,  None),
+    (0x4020, "Battery_Energy",               1, False, 10,  None),
+    (0x301F, "Battery_BMS_Type",             1, False, 1,   None),
+    (0x3020, "Battery_Type",                 1, False, 1,   {1: "Bleigel/Säure Batterie", 2: "LiFePo4 Batterie", None: None}),
+    (0x3021, "Battery_Voltage_Type",         1, False, 1,   {0: "48V", 1: "51.2V", None: None}),
+    (0x3022, "Battery_Capacity",             1, False, 1,   None),
+    (0x3027, "Battery_BMS_Max_Voltage",      1, False, 10,  None),
+    (0x3028, "Battery_BMS_Max_Current",      1, False, 100, None),
+    (0x3029, "Battery_BMS_Min_Voltage",      1, False, 10,  None),
+    (0x302A, "Battery_Max_Voltage",          1, False, 10,  None),
+    (0x302B, "Battery_Max_Current",          1, False, 100, None),
+    (0x302C, "Battery_Min_Voltage",          1, False, 10,  None),
+    (0x4022, "EM_Online",                    1, False, 1,   {1: "Online", 2: "Disabled", None: "Offline"}),
+    (0x4029, "EM_A_Power",                   2, True,  10,  None),
+    (0x4026, "EM_A_Current",                 1, False, 100, None),
+    (0x4023, "EM_A_Voltage",                 1, False, 10,  None),
+    (0x402B, "EM_B_Power",                   2, True,  10,  None),
+    (0x4027, "EM_B_Current",                 1, False, 100, None),
+    (0x4024, "EM_B_Voltage",                 1, False, 10,  None),
+    (0x402D, "EM_C_Power",                   2, True,  10,  None),
+    (0x4028, "EM_C_Current",                 1, False, 100, None),
+    (0x4025, "EM_C_Voltage",                 1, False, 10,  None),
+    (0x403A, "EM_Total_Power",               2, True,  10,  None),
+]
 
 ################################################################################
 #                                  Funktionen                                  #
@@ -59,46 +204,75 @@ EMS_Power_Limit_Value = 0x0000
 
 ################################################################################
 # Funktion zum Schreiben von Protokollnachrichten
-# Diese Funktion erstellt eine Protokollnachricht mit einem bestimmten
-# Protokollierungsgrad und gibt sie je nach festgelegtem Protokollierungsgrad aus.
-# Die Nachricht wird mit einem Zeitstempel und dem Protokollierungsgrad versehen.
+# Diese Funktion übergibt eine Protokollnachricht mit einem bestimmten Protokollierungsgrad an den Logger.
+# Die Argumente werden erst eingesetzt, wenn der Protokollierungsgrad ausgegeben wird (%-Formatierung),
+# sodass deaktivierte DEBUG-Nachrichten nahezu nichts kosten. Zeitstempel und Protokollierungsgrad
+# ergänzt der Formatierer beim Schreiben.
 #
 # Parameter:
-# - message: Die zu protokollierende Nachricht.
+# - message: Die zu protokollierende Nachricht mit %-Platzhaltern.
 # - log_level: Der Protokollierungsgrad der Nachricht (DEBUG, INFO, WARNING, ERROR, CRITICAL).
-def write_log(message, log_level):
+# - args: Die Werte für die Platzhalter der Nachricht.
+def write_log(message, log_level, *args):
+    
+    logger.log(log_level, message, *args)
+
+logger = logging.getLogger("ems_rs485_to_mqtt")
+
+# Funktion zur Einrichtung der Protokollierung
+# Diese Funktion leitet alle Protokollnachrichten über eine Warteschlange (QueueHandler) an einen eigenen
+# Thread (QueueListener) weiter, der sie in die Protokolldatei und auf die Konsole schreibt. So warten der
+# Lese- und der Veröffentlichungs-Thread nie auf langsame Schreibzugriffe, z.B. auf die SD-Karte.
+#
+# Rückgabewert:
+# - listener: Der gestartete QueueListener, der beim Beenden gestoppt werden muss.
+def setup_logging():
     
-    # Holt den Namen des Protokollierungsgrads.
-    log_level_text = LOG_LEVEL_NAMES.get(log_level)
+    formatter = logging.Formatter("%(asctime)s: %(levelname)s: %(message)s")
+    file_handler = logging.FileHandler(LOG_FILE)
+    console_handler = logging.StreamHandler(sys.stdout)
     
-    # Formatiert die Nachricht mit dem aktuellen Zeitstempel und dem Protokollierungsgrad.
-    message = f"{datetime.now()}: {log_level_text}: {message}"
+    for handler in (file_handler, console_handler):
     
-    # Gibt die Nachricht aus, wenn der Protokollierungsgrad größer oder gleich dem festgelegten Grad ist.
-    if log_level >= LOG_LEVEL:
+        handler.setFormatter(formatter)
     
-        print(message)
+    log_queue = queue.SimpleQueue()
     
-    # Schreibt die Nachricht in das entsprechende Protokoll basierend auf dem Protokollierungsgrad.
-    if log_level == logging.DEBUG:
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
     
-        logging.debug(message)
-            
-    elif log_level == logging.INFO:
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    listener.start()
     
-        logging.info(message)
-            
-    elif log_level == logging.WARNING:
+    return listener
+
+# Funktion zum Beenden aller Threads
+# Diese Funktion setzt das Flag `running` zurück und weckt den Lese-, den Veröffentlichungs- und den
+# MQTT-Thread auf, die blockierend warten, damit sie sich sofort beenden können.
+def stop_running():
     
-        logging.warning(message)
-            
-    elif log_level == logging.ERROR:
+    running.clear()
+    mqtt_wakeup.set()
     
-        logging.error(message)
-            
-    elif log_level == logging.CRITICAL:
+    for bus in buses:
+    
+        bus.wakeup.set()
+    
+    # Schließt die Warteschlange als Signal zum Beenden.
+    data_queue.close()
+
+# Funktion zur Behandlung von SIGTERM
+# Diese Funktion beendet das Skript bei SIGTERM (z.B. `systemctl stop`) wie bei Strg+C über stop_running(),
+# sodass die Verbindungen geschlossen und die Registerwerte gesichert werden.
+#
+# Parameter:
+# - signum, frame: Vom Signal-Modul übergeben (in der asyncio-Laufzeit nicht vorhanden).
+def handle_sigterm(signum=None, frame=None):
+    
+    write_log("EMS - Received SIGTERM, shutting down", logging.INFO)
     
-        logging.critical(message)
+    stop_running()
 
 ################################################################################
 # Funktion für die MQTT-Verbindung
@@ -122,23 +296,44 @@ def on_connect(client, userdata, flags, rc):
         5: "Connection refused - not authorised"
     }
     
-    # Abonniert relevante Themen für den Client.
-    client.subscribe("solar/ems/" + EMS_Nr + "/EMS_EM/turn")
-    client.subscribe("solar/ems/" + EMS_Nr + "/EMS_Bypass/turn")
-    client.subscribe("solar/ems/" + EMS_Nr + "/EMS_Power_Limit/set")
-    
     # Überprüft den Rückgabecode und protokolliert entsprechend den Verbindungsstatus.
     if rc == 0:
     
-        write_log(f"MQTT - Connected to MQTT broker with result code {rc}: {connection_results.get(rc)}", logging.INFO)
-        write_log(f"MQTT - Client: {client}, Userdata: {userdata}, Flags: {flags}", logging.DEBUG)
+        write_log("MQTT - Connected to MQTT broker with result code %s: %s", logging.INFO, rc, connection_results.get(rc))
+        write_log("MQTT - Client: %s, Userdata: %s, Flags: %s", logging.DEBUG, client, userdata, flags)
+        
+        # Abonniert relevante Themen für den Client (je EMS).
+        for device in devices:
+        
+            client.subscribe(device.topic_prefix + "EMS_EM/turn")
+            client.subscribe(device.topic_prefix + "EMS_Bypass/turn")
+            client.subscribe(device.topic_prefix + "EMS_Power_Limit/set")
+            
+            # Veröffentlicht den bekannten Status erneut, falls er während einer Unterbrechung verloren ging.
+            if device.breaker.online is not None:
+            
+                publish_status(device)
+        
+        mqtt_connected.set()
+        
+        if spool is not None and spool.pending():
+        
+            write_log("MQTT - Replaying %s spooled byte(s) at %s block(s)/s", logging.INFO, spool.size, MQTT_SPOOL_REPLAY_RATE)
+        
+        # Weckt den Veröffentlichungs-Thread für den Warmstart und das Nachsenden auf.
+        data_queue.wake()
+        
+    elif rc == 3:
+    
+        # Der Broker startet gerade; die Verbindung wird im Hintergrund erneut versucht.
+        write_log("MQTT - Failed to connect to MQTT broker with result code %s: %s", logging.WARNING, rc, connection_results.get(rc))
         
     else:
     
-        write_log(f"MQTT - Failed to connect to MQTT broker with result code {rc}: {connection_results.get(rc, 'Unknown error')}", logging.CRITICAL)
-        write_log(f"MQTT - Client: {client}, Userdata: {userdata}, Flags: {flags}", logging.DEBUG)
+        write_log("MQTT - Failed to connect to MQTT broker with result code %s: %s", logging.CRITICAL, rc, connection_results.get(rc, 'Unknown error'))
+        write_log("MQTT - Client: %s, Userdata: %s, Flags: %s", logging.DEBUG, client, userdata, flags)
         
-        running.clear()
+        stop_running()
 
 # Funktion zur Verarbeitung empfangener MQTT-Nachrichten
 # Diese Funktion wird aufgerufen, wenn der Client eine Nachricht von einem abonnierten Thema empfängt.
@@ -151,14 +346,16 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     
     # Protokolliert die empfangene Nachricht.
-    write_log(f"MQTT - Message received: {msg.topic} - {msg.payload}", logging.DEBUG)
+    write_log("MQTT - Message received: %s - %s", logging.DEBUG, msg.topic, msg.payload)
     
     # Verarbeitet die empfangene Nachricht weiter.
     process_mqtt_message(msg.topic, msg.payload)
 
 # Funktion zur Handhabung der MQTT-Trennung
 # Diese Funktion wird aufgerufen, wenn der Client die Verbindung zum MQTT-Broker verliert.
-# Sie protokolliert unerwartete Trennungen und versucht, die Verbindung wiederherzustellen.
+# Sie protokolliert unerwartete Trennungen. Die Verbindung wird im MQTT-Thread (bzw. in der Coroutine
+# mqtt_reconnect_async()) wiederhergestellt, damit die Abfragen der EMS weiterlaufen; bis dahin werden
+# die gelesenen Registerblöcke im Zwischenspeicher abgelegt.
 #
 # Parameter:
 # - client: Das Client-Objekt, das die Verbindung verloren hat.
@@ -166,69 +363,143 @@ def on_message(client, userdata, msg):
 # - rc: Rückgabecode der Trennung.
 def on_disconnect(client, userdata, rc):
     
+    mqtt_connected.clear()
+    
     # Überprüft, ob die Trennung unerwartet war (Rückgabecode ungleich 0).
     if rc != 0:
     
-        write_log("MQTT - Unexpected disconnection. Trying to reconnect...", logging.WARNING)
-        
-        try:
+        write_log("MQTT - Unexpected disconnection with result code %s, reconnecting in the background", logging.WARNING, rc)
+
+# Funktion zum Verbindungsaufbau beim Start
+# Diese Funktion verbindet den Client mit dem MQTT-Broker. Ist der Broker nicht erreichbar, wird die Verbindung
+# wie nach einer Trennung im Hintergrund erneut versucht, während die Abfragen der EMS bereits beginnen.
+def mqtt_connect():
+    
+    try:
+    
+        client.connect(MQTT_BROKER, MQTT_PORT)
         
-             # Versucht, die Verbindung wiederherzustellen.
-            client.reconnect()
-            
-        except Exception as e:
+    except Exception as e:
+    
+        write_log("MQTT - Broker %s:%s not reachable (%s), connecting in the background", logging.WARNING, MQTT_BROKER, MQTT_PORT, e)
+
+# Funktion für einen erneuten Verbindungsversuch
+#
+# Parameter:
+# - attempt: Die Nummer des Versuchs (ab 1).
+def mqtt_reconnect(attempt):
+    
+    write_log("MQTT - Reconnecting to %s:%s (attempt %s)", logging.INFO, MQTT_BROKER, MQTT_PORT, attempt)
+    
+    try:
+    
+        client.reconnect()
         
-            # Protokolliert, wenn der Verbindungsversuch fehlschlägt, und führt eine Fehlerbehandlung durch.
-            write_log(f"MQTT - Reconnect failed: {e}", logging.CRITICAL)
-            
-            running.clear()
+    except Exception as e:
+    
+        write_log("MQTT - Reconnect failed: %s", logging.WARNING, e)
+
+# Funktion zur Berechnung der Wartezeit vor einem Verbindungsversuch
+# Die Wartezeit verdoppelt sich mit jedem Versuch bis `MQTT_RECONNECT_DELAY_MAX` und wird zufällig zwischen
+# der Hälfte und dem vollen Wert gestreut, damit nach einem Neustart des Brokers nicht alle Clients
+# gleichzeitig verbinden.
+#
+# Parameter:
+# - attempt: Die Anzahl der bisherigen Versuche (ab 0).
+#
+# Rückgabewert:
+# - delay: Die Wartezeit in Sekunden.
+def reconnect_delay(attempt):
+    
+    delay = min(MQTT_RECONNECT_DELAY * (2 ** attempt), MQTT_RECONNECT_DELAY_MAX)
+    
+    return random.uniform(delay / 2, delay)
 
 ################################################################################
 # Funktion zur Verarbeitung spezifischer MQTT-Nachrichten
 # Diese Funktion wird aufgerufen, um empfangene MQTT-Nachrichten basierend auf ihrem Thema und Inhalt zu verarbeiten.
-# Sie aktualisiert globale Variablen und protokolliert entsprechende Aktionen.
+# Sie legt den entsprechenden Schreibbefehl in die Befehlswarteschlange und protokolliert entsprechende Aktionen.
 #
 # Parameter:
 # - topic: Das Thema der empfangenen Nachricht.
 # - message: Die empfangene Nachricht, die den Payload enthält.
 def process_mqtt_message(topic, message):
     
-    # Globale Variablen für EMS-Status und Werte.
-    global EMS_EM_FLG
-    global EMS_EM_Value
-    global EMS_Bypass_FLG
-    global EMS_Bypass_Value
-    global EMS_Power_Limit_FLG
-    global EMS_Power_Limit_Value
-    
     # Dekodiert die empfangene Nachricht.
     decoded_message = message.decode('utf-8')
     
+    # Ermittelt das EMS anhand des Themas.
+    device = None
+    
+    for candidate in devices:
+    
+        if topic.startswith(candidate.topic_prefix):
+        
+            device = candidate
+            command = topic[len(candidate.topic_prefix):]
+    
+    if device is None:
+    
+        return
+    
     # Verarbeitet Nachrichten für das Thema "EMS_EM/turn".
-    if topic == "solar/ems/" + EMS_Nr + "/EMS_EM/turn" and decoded_message == "on":
-        EMS_EM_FLG = True
-        EMS_EM_Value = 1
-        write_log(f"EMS - EMS_EM turn on is set", logging.INFO)
-    elif topic == "solar/ems/" + EMS_Nr + "/EMS_EM/turn" and decoded_message == "off":
-        EMS_EM_FLG = True
-        EMS_EM_Value = 0
-        write_log(f"EMS - EMS_EM turn off is set", logging.INFO)
+    if command == "EMS_EM/turn" and decoded_message == "on":
+        queue_command(device, 0x303B, 1, "EMS_EM")
+        write_log("EMS %s - EMS_EM turn on is set", logging.INFO, device.nr)
+    elif command == "EMS_EM/turn" and decoded_message == "off":
+        queue_command(device, 0x303B, 0, "EMS_EM")
+        write_log("EMS %s - EMS_EM turn off is set", logging.INFO, device.nr)
     
     # Verarbeitet Nachrichten für das Thema "EMS_Bypass/turn".
-    elif topic == "solar/ems/" + EMS_Nr + "/EMS_Bypass/turn" and decoded_message == "on":
-        EMS_Bypass_FLG = True
-        EMS_Bypass_Value = 1
-        write_log(f"EMS - EMS_Bypass turn on is set", logging.INFO)
-    elif topic == "solar/ems/" + EMS_Nr + "/EMS_Bypass/turn" and decoded_message == "off":
-        EMS_Bypass_FLG = True
-        EMS_Bypass_Value = 0
-        write_log(f"EMS - EMS_Bypass turn off is set", logging.INFO)
+    elif command == "EMS_Bypass/turn" and decoded_message == "on":
+        queue_command(device, 0x3039, 1, "EMS_Bypass")
+        write_log("EMS %s - EMS_Bypass turn on is set", logging.INFO, device.nr)
+    elif command == "EMS_Bypass/turn" and decoded_message == "off":
+        queue_command(device, 0x3039, 0, "EMS_Bypass")
+        write_log("EMS %s - EMS_Bypass turn off is set", logging.INFO, device.nr)
     
     # Verarbeitet Nachrichten für das Thema "EMS_Power_Limit/set".
-    elif topic == "solar/ems/" + EMS_Nr + "/EMS_Power_Limit/set" and is_valid_EMS_Power_Limit(decoded_message):
-        EMS_Power_Limit_FLG = True
-        EMS_Power_Limit_Value = int(decoded_message)
-        write_log(f"EMS - EMS_Power_Limit change to {EMS_Power_Limit_Value}W is set", logging.INFO)
+    elif command == "EMS_Power_Limit/set" and is_valid_EMS_Power_Limit(decoded_message):
+        queue_command(device, 0x302E, int(decoded_message), "EMS_Power_Limit")
+        write_log("EMS %s - EMS_Power_Limit change to %sW is set", logging.INFO, device.nr, int(decoded_message))
+
+# Funktion zum Einreihen eines Schreibbefehls
+# Diese Funktion legt einen Schreibbefehl threadsicher in die Befehlswarteschlange und weckt den Lese-Thread auf,
+# damit der Befehl vor der nächsten Busabfrage ausgeführt wird. Ein noch nicht ausgeführter Befehl für dasselbe
+# Register wird dabei durch den neuen Wert ersetzt, sodass nur der letzte Wert geschrieben wird.
+#
+# Parameter:
+# - device: Das zu beschreibende EMS.
+# - register_address: Die Adresse des zu beschreibenden Registers.
+# - value: Der zu schreibende Wert.
+# - name: Der Name des Befehls für die Protokollierung.
+def queue_command(device, register_address, value, name):
+    
+    with command_lock:
+    
+        pending_commands[(device, register_address)] = (value, name)
+    
+    device.bus.wakeup.set()
+
+# Funktion zum Entnehmen aller anstehenden Schreibbefehle eines Busses
+# Diese Funktion entnimmt threadsicher alle anstehenden Befehle für die EMS an einem Bus aus der Befehlswarteschlange.
+#
+# Parameter:
+# - bus: Der RS485-Bus, dessen Befehle entnommen werden.
+#
+# Rückgabewert:
+# - commands: Ein Wörterbuch (EMS, Registeradresse) -> (Wert, Name).
+def take_commands(bus):
+    
+    with command_lock:
+    
+        commands = {key: command for key, command in pending_commands.items() if key[0].bus is bus}
+        
+        for key in commands:
+        
+            del pending_commands[key]
+    
+    return commands
 
 # Funktion zur Überprüfung der Gültigkeit eines EMS-Leistungsbegrenzungswerts
 # Diese Funktion überprüft, ob ein gegebener Wert ein gültiger Leistungsbegrenzungswert
@@ -265,16 +536,16 @@ def is_valid_EMS_Power_Limit(value):
     return is_valid
 
 ################################################################################
-# Funktion zur Berechnung der CRC-16-Prüfsumme
-# Diese Funktion berechnet die CRC-16-Prüfsumme für ein gegebenes Datenarray.
-# Das CRC-Verfahren wird verwendet, um die Integrität von Daten zu überprüfen.
+# Funktion zur Berechnung der CRC-16-Prüfsumme (Referenz)
+# Diese Funktion berechnet die CRC-16-Prüfsumme für ein gegebenes Datenarray bitweise.
+# Sie dient als Referenz, gegen die die schnelleren Implementierungen geprüft werden.
 #
 # Parameter:
 # - data: Ein Array von Bytes, für das die CRC-Prüfsumme berechnet werden soll.
 #
 # Rückgabewert:
 # - crc: Die berechnete CRC-16-Prüfsumme.
-def calculate_crc(data):
+def calculate_crc_bitwise(data):
     
     crc = 0xFFFF
     
@@ -291,6 +562,82 @@ def calculate_crc(data):
                 crc >>= 1
                 
     return crc
+
+# Funktion zum Erstellen der CRC-16-Tabelle
+# Diese Funktion berechnet für jeden der 256 möglichen Bytewerte das Ergebnis der acht Schiebeschritte vorab.
+#
+# Rückgabewert:
+# - table: Eine Liste mit 256 Einträgen.
+def build_crc_table():
+    
+    table = []
+    
+    for byte in range(256):
+    
+        crc = byte
+        
+        for i in range(8):
+        
+            if (crc & 0x0001) != 0:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        
+        table.append(crc)
+    
+    return table
+
+CRC16_TABLE = build_crc_table()
+
+# Funktion zur Berechnung der CRC-16-Prüfsumme über die Tabelle
+# Diese Funktion liefert dasselbe Ergebnis wie die bitweise Berechnung, benötigt aber nur einen
+# Tabellenzugriff pro Byte.
+#
+# Parameter:
+# - data: Ein Array von Bytes, für das die CRC-Prüfsumme berechnet werden soll.
+#
+# Rückgabewert:
+# - crc: Die berechnete CRC-16-Prüfsumme.
+def calculate_crc_table(data):
+    
+    crc = 0xFFFF
+    table = CRC16_TABLE
+    
+    for pos in data:
+    
+        crc = (crc >> 8) ^ table[(crc ^ pos) & 0xFF]
+    
+    return crc
+
+# Funktion zur Auswahl der CRC-16-Implementierung
+# Diese Funktion wählt die schnellste verfügbare Implementierung (kompiliert über crcmod, sonst Tabelle)
+# und prüft sie vorher mit Zufallsdaten gegen die bitweise Referenz. Liefert eine Implementierung
+# abweichende Ergebnisse, wird sie nicht verwendet.
+#
+# Rückgabewert:
+# - name: Der Name der gewählten Implementierung.
+# - crc_function: Die Funktion zur CRC-Berechnung.
+def select_crc_implementation():
+    
+    candidates = []
+    
+    if crcmod is not None:
+    
+        candidates.append(("crcmod", crcmod.predefined.mkPredefinedCrcFun('modbus')))
+    
+    candidates.append(("table", calculate_crc_table))
+    
+    samples = [os.urandom(length) for length in range(64) for i in range(4)]
+    
+    for name, crc_function in candidates:
+    
+        if all(crc_function(sample) == calculate_crc_bitwise(sample) for sample in samples):
+        
+            return name, crc_function
+    
+    return "bitwise", calculate_crc_bitwise
+
+CRC_IMPLEMENTATION, calculate_crc = select_crc_implementation()
     
 # Funktion zur Konstruktion eines Modbus-Rahmens
 # Diese Funktion erstellt einen Modbus-Rahmen basierend auf den angegebenen Parametern.
@@ -317,621 +664,3034 @@ def construct_frame(boot_code, device_address, function_code, register_address,
 
 # Funktion zum Senden eines Modbus-Rahmens
 # Diese Funktion sendet einen vorbereiteten Modbus-Rahmen über eine serielle Schnittstelle.
-# Sie protokolliert den gesendeten Rahmen im Hexadezimalformat und schreibt ihn in den seriellen Puffer.
+# Sie verwirft zuvor Reste im Empfangspuffer, protokolliert den gesendeten Rahmen im
+# Hexadezimalformat und schreibt ihn in den seriellen Puffer.
 #
 # Parameter:
+# - bus: Der RS485-Bus, über den gesendet wird.
 # - frame: Der zu sendende Modbus-Rahmen als Byte-Array.
-def send_frame(frame):
+def send_frame(bus, frame):
+    
+    # Protokolliert den zu sendenden Rahmen im Hexadezimalformat (nur wenn DEBUG aktiv ist).
+    if logger.isEnabledFor(logging.DEBUG):
+    
+        write_log("EMS - Sending frame: %s", logging.DEBUG, frame.hex())
+    
+    started = time.perf_counter()
     
-    # Protokolliert den zu sendenden Rahmen im Hexadezimalformat.
-    write_log(f"EMS - Sending frame: {frame.hex()}", logging.DEBUG)
+    # Verwirft Reste einer früheren Antwort, damit sie nicht als neue Antwort gelesen werden.
+    bus.ser.reset_input_buffer()
+    bus.decoder.reset()
     
     # Schreibt den Rahmen in den seriellen Puffer.
-    ser.write(frame)
+    bus.ser.write(frame)
+    
+    stage_timer.add("serial_write", started)
 
-# Funktion zum Empfangen und Validieren einer Modbus-Antwort
-# Diese Funktion liest die Antwort von der seriellen Schnittstelle und prüft,
-# ob sie mit dem Basisrahmen übereinstimmt. Sie versucht bis zu dreimal,
-# eine gültige Antwort zu empfangen.
+# Funktion zur Berechnung der erwarteten Antwortlänge
+# Diese Funktion bestimmt anhand des Funktionscodes, wie viele Bytes das EMS auf einen Rahmen zurücksendet.
+# Bei 0x03 (Lesen) sind es Kopf, Registerwerte und CRC, bei 0x10 (Schreiben) ein Echo des gesendeten Rahmens.
 #
 # Parameter:
-# - frame_base: Der Basisrahmen der gesendeten Nachricht, gegen den die Antwort validiert wird.
+# - frame: Der vollständige gesendete Rahmen inklusive CRC.
 #
 # Rückgabewert:
-# - response: Der empfangene Antwortrahmen als Byte-Array.
-def receive_response(frame_base):
+# - expected_length: Die erwartete Länge der Antwort in Bytes.
+def expected_response_length(frame):
     
-    found = False
-    count = 0
-    response = ""
+    function_code = frame[3]
     
-    while found == False and count < 3 and running.is_set():
+    if function_code == 0x03:
     
-        # Liest alle verfügbaren Daten aus der seriellen Schnittstelle.
-        response = ser.readall()
+        register_count = struct.unpack_from('>H', frame, 6)[0]
         
-        # Extrahiert den Basisrahmen aus der Antwort.
-        response_base = response[:8]
-        
-        count += 1
-        
-        # Überprüft, ob der Basisrahmen der Antwort mit dem gesendeten Basisrahmen übereinstimmt.
-        if frame_base == response_base:
-            
-            # Protokolliert den empfangenen Rahmen im Hexadezimalformat.
-            write_log(f"EMS - Response frame: {response.hex()}", logging.DEBUG)
-            write_log(f"EMS - Response frame: Is valid!", logging.DEBUG)
-            
-            found = True
-        
-        else:
-        
-            # Protokolliert den empfangenen Rahmen im Hexadezimalformat.
-            write_log(f"EMS - Response frame: {response.hex()}", logging.DEBUG)
-            
-    # Gibt die empfangene Antwort zurück
-    return response
+        return 10 + (register_count * 2)
+    
+    return len(frame)
 
-################################################################################
-# Funktion zum Anfordern und Verarbeiten von EMS-Registerwerten
-# Diese Funktion erstellt und sendet einen Modbus-Rahmen, um Daten aus spezifizierten EMS-Registern anzufordern.
-# Sie versucht, eine gültige Antwort zu erhalten, und verarbeitet die Registerwerte.
+# Funktion zur Berechnung der Zeichenpause
+# Diese Funktion berechnet aus Baudrate und Rahmenformat die Zeit, nach der eine Antwort als beendet gilt,
+# wenn keine weiteren Bytes mehr eintreffen. Die Untergrenze deckt die Latenz von USB-Adaptern ab.
 #
-# Parameter:
-# - register_address: Die Adresse des ersten Registers, das angefordert werden soll.
-# - register_count: Die Anzahl der Register, die angefordert werden sollen.
-def request_ems(register_address,register_count):
-
-    response_valid = False
+# Rückgabewert:
+# - inter_byte_timeout: Die Zeichenpause in Sekunden.
+def inter_byte_timeout():
     
-    boot_code = [0xA5, 0x5A]
-    device_address = 0x01
-    function_code = 0x03
+    # Startbit + Datenbits + Paritätsbit + Stoppbits
+    bits_per_char = 1 + RS485_BYTESIZE + (0 if RS485_PARITY == serial.PARITY_NONE else 1) + RS485_STOPBITS
+    char_time = bits_per_char / RS485_BAUD_RATE
     
-    # Konstruiert den Basisrahmen.
-    frame_base = construct_frame(boot_code, device_address, function_code, register_address, register_count)
+    return max(RS485_INTER_BYTE_CHARS * char_time, RS485_INTER_BYTE_MIN_TIMEOUT)
+
+# Klasse zur fortlaufenden Zerlegung des Empfangsstroms in Rahmen
+# Diese Klasse sammelt empfangene Bytes in einem Puffer, sucht darin nach dem Startcode 0xA5 0x5A
+# und gibt vollständige Rahmen mit gültiger Länge und CRC-Prüfsumme zurück. Ungültige Bytes werden
+# einzeln verworfen, sodass ein direkt folgender Rahmen erhalten bleibt.
+class FrameDecoder:
+
+    BOOT_CODE = b"\xA5\x5A"
+    MAX_REGISTER_COUNT = 0x7D
     
-    # Berechnet die CRC-Prüfsumme und fügt sie an den Rahmen an.
-    frame_crc = calculate_crc(frame_base)
-    frame = bytes(frame_base) + struct.pack('<H', frame_crc)
+    def __init__(self):
     
-    # Temporäre Variablen zur Speicherung von Registerwerten.
-    Temp_400E_value = 0x0000
-    has_400E_value = False
+        self.buffer = bytearray()
+        self.discarded = 0
     
-    Temp_4010_value = 0x0000
-    has_4010_value = False
+    # Leert den Puffer, z.B. vor einer neuen Anfrage.
+    def reset(self):
     
-    Temp_4029_value = 0x0000
-    has_4029_value = False
+        self.buffer.clear()
     
-    Temp_402B_value = 0x0000
-    has_402B_value = False
+    # Hängt empfangene Bytes an den Puffer an.
+    def feed(self, data):
     
-    Temp_402D_value = 0x0000
-    has_402D_value = False
+        self.buffer += data
     
-    Temp_403A_value = 0x0000
-    has_403A_value = False
+    # Mögliche Rahmenlängen anhand des Kopfes. Ein Schreib-Echo (0x10) kann mit oder ohne Daten zurückkommen.
+    def frame_lengths(self, function_code, register_count):
     
-    # Sendet den Rahmen und wartet auf eine gültige Antwort.
-    while response_valid == False and running.is_set():
+        if register_count > self.MAX_REGISTER_COUNT:
+        
+            return ()
+        
+        if function_code == 0x03:
+        
+            return (10 + (register_count * 2),)
+        
+        if function_code == 0x10:
+        
+            return (10, 10 + (register_count * 2))
+        
+        return ()
     
-        send_frame(frame)
+    # Verwirft die ersten count Bytes des Puffers.
+    def discard(self, count):
+    
+        if logger.isEnabledFor(logging.DEBUG):
         
-        response = receive_response(frame_base)
+            write_log("EMS - Discarding %s byte(s): %s", logging.DEBUG, count, bytes(self.buffer[:count]).hex())
         
-        if response:
+        del self.buffer[:count]
+        self.discarded += count
+    
+    # Gibt den nächsten vollständigen Rahmen zurück oder None, wenn weitere Bytes benötigt werden.
+    def next_frame(self):
+    
+        while True:
         
-            response_valid, register_values = parse_response(response, frame_base, register_count)
+            # Sucht den Startcode und verwirft alles davor.
+            start = self.buffer.find(self.BOOT_CODE)
             
-            if response_valid == True:
+            if start < 0:
             
-                for i, value in enumerate(register_values):
+                # Ein einzelnes 0xA5 am Ende kann der Anfang eines Rahmens sein.
+                keep = 1 if self.buffer[-1:] == self.BOOT_CODE[:1] else 0
                 
-                    value_address = register_address + i
-                    
-                    # Verarbeitung für spezielle Register, die 4 Byte umfassen.
-                    # 0x400E
-                    if value_address == 0x400E:
-                    
-                        Temp_400E_value = value
-                        has_400E_value = True
-                        
-                    elif value_address == 0x400F and has_400E_value == True:
-                    
-                        Temp_400E_value = format(Temp_400E_value, '04x') + format(value, '04x')
-                        Temp_400E_value = int(Temp_400E_value, 16)
-                        
-                        data_queue.put({"value_address": hex(0x400E), "value": Temp_400E_value})
-                        
-                        Temp_400E_value = 0x0000
-                        has_400E_value = False
-                        
-                    # 0x4010
-                    elif value_address == 0x4010:
-                    
-                        Temp_4010_value = value
-                        has_4010_value = True
-                        
-                    elif value_address == 0x4011 and has_4010_value == True:
-                    
-                        Temp_4010_value = format(Temp_4010_value, '04x') + format(value, '04x')
-                        Temp_4010_value = int(Temp_4010_value, 16)
-                        
-                        data_queue.put({"value_address": hex(0x4010), "value": Temp_4010_value})
-                        
-                        Temp_4010_value = 0x0000
-                        has_4010_value = False
-                        
-                    # 0x4029
-                    elif value_address == 0x4029:
-                    
-                        Temp_4029_value = value
-                        has_4029_value = True
-                        
-                    elif value_address == 0x402A and has_4029_value == True:
-                    
-                        Temp_4029_value = format(Temp_4029_value, '04x') + format(value, '04x')
-                        Temp_4029_value = int(Temp_4029_value, 16)
-                        
-                        data_queue.put({"value_address": hex(0x4029), "value": Temp_4029_value})
-                        
-                        Temp_4029_value = 0x0000
-                        has_4029_value = False
-                        
-                    # 0x402B
-                    elif value_address == 0x402B:
-                    
-                        Temp_402B_value = value
-                        has_402B_value = True
-                        
-                    elif value_address == 0x402C and has_402B_value == True:
-                    
-                        Temp_402B_value = format(Temp_402B_value, '04x') + format(value, '04x')
-                        Temp_402B_value = int(Temp_402B_value, 16)
-                        
-                        data_queue.put({"value_address": hex(0x402B), "value": Temp_402B_value})
-                        
-                        Temp_402B_value = 0x0000
-                        has_402B_value = False
-                        
-                    # 0x402D
-                    elif value_address == 0x402D:
-                    
-                        Temp_402D_value = value
-                        has_402D_value = True
-                        
-                    elif value_address == 0x402E and has_402D_value == True:
-                    
-                        Temp_402D_value = format(Temp_402D_value, '04x') + format(value, '04x')
-                        Temp_402D_value = int(Temp_402D_value, 16)
-                        
-                        data_queue.put({"value_address": hex(0x402D), "value": Temp_402D_value})
-                        
-                        Temp_402D_value = 0x0000
-                        has_402D_value = False
-                        
-                    # 0x403A
-                    elif value_address == 0x403A:
-                    
-                        Temp_403A_value = value
-                        has_403A_value = True
-                        
-                    elif value_address == 0x403B and has_403A_value == True:
+                if len(self.buffer) > keep:
+                
+                    self.discard(len(self.buffer) - keep)
+                
+                return None
+            
+            if start > 0:
+            
+                self.discard(start)
+            
+            if len(self.buffer) < 8:
+            
+                return None
+            
+            function_code = self.buffer[3]
+            register_count = (self.buffer[6] << 8) | self.buffer[7]
+            
+            lengths = self.frame_lengths(function_code, register_count)
+            incomplete = False
+            
+            for length in lengths:
+            
+                if len(self.buffer) < length:
+                
+                    incomplete = True
                     
-                        Temp_403A_value = format(Temp_403A_value, '04x') + format(value, '04x')
-                        Temp_403A_value = int(Temp_403A_value, 16)
-                        
-                        data_queue.put({"value_address": hex(0x403A), "value": Temp_403A_value})
-                        
-                        Temp_403A_value = 0x0000
-                        has_403A_value = False
-                        
-                    # Alle anderen 2 Byte Register  
-                    else:
+                    break
+                
+                # Prüft die CRC-Prüfsumme auf einer Sicht des Puffers; nur ein gültiger Rahmen wird kopiert.
+                with memoryview(self.buffer) as view:
+                
+                    crc_received = view[length - 2] | (view[length - 1] << 8)
+                    frame = bytes(view[:length]) if calculate_crc(view[:length - 2]) == crc_received else None
+                
+                if frame is not None:
+                
+                    del self.buffer[:length]
                     
-                        data_queue.put({"value_address": hex(value_address), "value": value})
+                    return frame
+            
+            if incomplete:
+            
+                return None
+            
+            # Ein gültiger Kopf mit vollständigem Rahmen, aber falscher CRC-Prüfsumme.
+            if lengths:
+            
+                metrics.inc("ems_crc_errors_total")
+            
+            # Kein gültiger Rahmen an dieser Stelle: Startcode verwerfen und weitersuchen.
+            self.discard(1)
 
-# Funktion zum Schreiben von Daten in EMS-Register
-# Diese Funktion erstellt und sendet einen Modbus-Rahmen, um Daten in spezifizierte EMS-Register zu schreiben.
-# Sie versucht, eine gültige Antwort zu erhalten, und wiederholt den Vorgang bei Bedarf.
+# Funktion zum Empfangen und Validieren einer Modbus-Antwort
+# Diese Funktion liest Bytes von der seriellen Schnittstelle in den Rahmendecoder, bis ein Rahmen
+# gefunden wird, dessen Basisrahmen mit der gesendeten Nachricht übereinstimmt. Fremde oder veraltete
+# Rahmen und Störbytes werden verworfen, ohne die Anfrage erneut zu senden. Es wird höchstens
+# `RS485_TIMEOUT` Sekunden gewartet.
 #
 # Parameter:
-# - register_address: Die Adresse des ersten zu beschreibenden Registers.
-# - register_count: Die Anzahl der Register, die beschrieben werden sollen.
-# - register_data: Die Daten, die in die Register geschrieben werden sollen.
-def write_ems(register_address,register_count,register_data):
-
-    response_valid = False
-    
-    boot_code = [0xA5, 0x5A]
-    device_address = 0x01
-    function_code = 0x10
-    
-    # Konstruiert den Basisrahmen.
-    frame_base = construct_frame(boot_code, device_address, function_code, register_address, register_count)
-    frame = bytes(frame_base) + struct.pack('>H', register_data)
+# - bus: Der RS485-Bus, von dem gelesen wird.
+# - frame_base: Der Basisrahmen der gesendeten Nachricht, gegen den die Antwort validiert wird.
+# - expected_length: Die erwartete Länge der Antwort in Bytes.
+#
+# Rückgabewert:
+# - response: Der empfangene Antwortrahmen als Byte-Array (leer, wenn keine gültige Antwort empfangen wurde).
+def receive_response(bus, frame_base, expected_length):
     
-     # Berechnet die CRC-Prüfsumme und fügt sie an den Rahmen an.
-    frame_crc = calculate_crc(frame)
-    frame = bytes(frame) + struct.pack('<H', frame_crc)
+    decoder = bus.decoder
+    deadline = time.monotonic() + RS485_TIMEOUT
+    started = time.perf_counter()
+    waiting_for_first_byte = True
     
-    # Sendet den Rahmen und wartet auf eine gültige Antwort.
-    while response_valid == False and running.is_set():
+    while running.is_set():
     
-        send_frame(frame)
+        # Gibt alle bereits vollständigen Rahmen aus dem Puffer aus.
+        frame = decoder.next_frame()
+        
+        while frame is not None:
+        
+            # Protokolliert den empfangenen Rahmen im Hexadezimalformat (nur wenn DEBUG aktiv ist).
+            if logger.isEnabledFor(logging.DEBUG):
+            
+                write_log("EMS - Response frame: %s", logging.DEBUG, frame.hex())
+            
+            # Überprüft, ob der Basisrahmen der Antwort mit dem gesendeten Basisrahmen übereinstimmt.
+            if frame[:8] == frame_base:
+            
+                write_log("EMS - Response frame: Is valid!", logging.DEBUG)
+                
+                stage_timer.add("frame_read", started)
+                
+                return frame
+            
+            write_log("EMS - Response frame: Doesn't match the request, skipped!", logging.DEBUG)
+            
+            metrics.inc("ems_header_mismatches_total")
+            
+            frame = decoder.next_frame()
+        
+        if time.monotonic() >= deadline:
+        
+            break
+        
+        # Wartet zuerst auf ein einzelnes Byte, damit die Zeit bis zum Beginn der Antwort getrennt erfasst wird.
+        # Danach werden höchstens die noch fehlenden Bytes gelesen; read() kehrt nach der Zeichenpause zurück.
+        if waiting_for_first_byte:
+        
+            chunk = bus.ser.read(1)
+            
+            if chunk:
+            
+                stage_timer.add("first_byte", started)
+                
+                waiting_for_first_byte = False
+            
+        else:
+        
+            chunk = bus.ser.read(max(expected_length - len(decoder.buffer), 1))
         
-        response = receive_response(frame_base)
+        if not chunk:
         
-        if response:
+            break
         
-            response_valid = True
+        decoder.feed(chunk)
+    
+    # Gibt eine leere Antwort zurück, wenn kein passender Rahmen gefunden wurde.
+    return b""
 
 ################################################################################
-# Funktion zur Analyse und Validierung einer Modbus-Antwort
-# Diese Funktion prüft die Länge und Gültigkeit der empfangenen Antwort, extrahiert Registerwerte
-# und validiert die CRC-Prüfsumme.
+# Funktion zum Übertragen eines Rahmens über den Bus
+# Diese Funktion sendet einen Rahmen, wartet auf die passende Antwort und erfasst die Belegungszeit des Busses.
 #
 # Parameter:
-# - response: Der empfangene Modbus-Antwortrahmen als Byte-Array.
-# - frame_base: Der Basisrahmen der gesendeten Nachricht, gegen den die Antwort validiert wird.
-# - register_count: Die Anzahl der Register, deren Werte extrahiert werden sollen.
+# - bus: Der RS485-Bus, über den übertragen wird.
+# - frame: Der vollständige zu sendende Rahmen.
+# - frame_base: Der Basisrahmen, gegen den die Antwort validiert wird.
 #
 # Rückgabewert:
-# - response_valid: Ein boolescher Wert, der angibt, ob die Antwort gültig ist (True) oder nicht (False).
-# - register_values: Eine Liste der extrahierten Registerwerte.
-def parse_response(response, frame_base, register_count):
-   
-    response_valid = True
+# - response: Der empfangene Antwortrahmen als Byte-Array (leer, wenn keine gültige Antwort empfangen wurde).
+def transfer_frame(bus, frame, frame_base):
     
-    # Extrahiert den Basisrahmen aus der Antwort.
-    response_base = response[:8]
-    register_values = []
+    started = time.monotonic()
     
-    # Überprüft die Länge der Antwort.
-    if len(response) >= 10 + (register_count * 2):
+    send_frame(bus, frame)
     
-        response = response[:10 + (register_count * 2)]
+    response = receive_response(bus, frame_base, expected_response_length(frame))
+    
+    bus.stats.add(time.monotonic() - started)
+    
+    return response
+
+# Funktion zum Erstellen eines vollständigen Rahmens für ein EMS
+# Diese Funktion erstellt den Basisrahmen, hängt bei Schreibbefehlen die Daten an und ergänzt die CRC-Prüfsumme.
+#
+# Parameter:
+# - device: Das angesprochene EMS.
+# - function_code: Der Funktionscode (0x03 Lesen, 0x10 Schreiben).
+# - register_address: Die Adresse des ersten Registers.
+# - register_count: Die Anzahl der Register.
+# - register_data: Die zu schreibenden Daten (nur bei 0x10).
+#
+# Rückgabewert:
+# - frame: Der vollständige Rahmen inklusive CRC.
+# - frame_base: Der Basisrahmen, gegen den die Antwort validiert wird.
+def build_frame(device, function_code, register_address, register_count, register_data=None):
+    
+    boot_code = [0xA5, 0x5A]
+    started = time.perf_counter()
+    
+    # Konstruiert den Basisrahmen.
+    frame_base = construct_frame(boot_code, device.address, function_code, register_address, register_count)
+    frame = frame_base
+    
+    if register_data is not None:
+    
+        frame = frame + struct.pack('>H', register_data)
+    
+    stage_timer.add("frame_build", started)
+    started = time.perf_counter()
+    
+    # Berechnet die CRC-Prüfsumme und fügt sie an den Rahmen an.
+    frame_crc = calculate_crc(frame)
+    frame = frame + struct.pack('<H', frame_crc)
+    
+    stage_timer.add("crc", started)
+    
+    return frame, frame_base
+
+# Funktion zum Anfordern und Verarbeiten von EMS-Registerwerten
+# Diese Funktion erstellt und sendet einen Modbus-Rahmen, um Daten aus spezifizierten EMS-Registern anzufordern,
+# und verarbeitet die Registerwerte. Jeder Aufruf ist ein einzelner Versuch, damit ein EMS ohne Antwort den Bus
+# nicht für die übrigen EMS blockiert: Nach einem Fehler wird das EMS mit retry_delay() zurückgestellt und die
+# Anfrage höchstens `EMS_MAX_RETRIES` Mal wiederholt (siehe CircuitBreaker.retry()).
+#
+# Parameter:
+# - device: Das abzufragende EMS.
+# - register_address: Die Adresse des ersten Registers, das angefordert werden soll.
+# - register_count: Die Anzahl der Register, die angefordert werden sollen.
+#
+# Rückgabewert:
+# - response_valid: True, wenn eine gültige Antwort empfangen wurde.
+def request_ems(device, register_address, register_count):
+
+    if not running.is_set():
+    
+        return False
+    
+    labels = request_labels(device, register_address)
+    
+    frame, frame_base = build_frame(device, 0x03, register_address, register_count)
+    
+    if device.breaker.attempt:
+    
+        metrics.inc("ems_request_retries_total", labels)
+    
+    # Sendet den Rahmen und wartet auf eine gültige Antwort.
+    started = time.monotonic()
+    
+    response = transfer_frame(device.bus, frame, frame_base)
+    duration = time.monotonic() - started
+    
+    metrics.observe("ems_request_duration_seconds", labels, duration)
+    
+    if response and process_response(device, response, frame_base, register_address, register_count):
+    
+        device_succeeded(device)
+        
+        return True
+    
+    request_failed(device, duration)
+    
+    return False
+
+# Funktion zur Berechnung der Wartezeit vor einer Wiederholung
+# Die Wartezeit verdoppelt sich mit jedem fehlgeschlagenen Versuch bis höchstens `EMS_RETRY_BACKOFF_MAX` Sekunden.
+#
+# Parameter:
+# - attempt: Die Anzahl der fehlgeschlagenen Versuche in Folge (ab 1).
+#
+# Rückgabewert:
+# - delay: Die Wartezeit in Sekunden.
+def retry_delay(attempt):
+    
+    return min(EMS_RETRY_BACKOFF * (2 ** (attempt - 1)), EMS_RETRY_BACKOFF_MAX)
+
+# Funktion zur Verarbeitung eines fehlgeschlagenen Leseversuchs
+# Diese Funktion rechnet die Dauer des Versuchs dem Bus als verlorene Zeit an (sie zählt nicht als Verzug der
+# übrigen Registerblöcke) und stellt das EMS bis zur Wiederholung zurück. Sind alle Versuche verbraucht, zählt
+# die Anfrage als fehlgeschlagen.
+#
+# Parameter:
+# - device: Das EMS, das nicht geantwortet hat.
+# - duration: Die Dauer des Versuchs in Sekunden.
+def request_failed(device, duration):
+    
+    device.bus.stats.lost += duration
+    
+    if device.breaker.retry(time.monotonic()):
+    
+        return
+    
+    device_failed(device)
+
+# Funktion zur Verarbeitung einer erfolgreichen Übertragung
+# Diese Funktion setzt den Fehlerzähler des EMS zurück. War das EMS offline, werden alle Registerblöcke
+# sofort neu eingeplant und der Status "online" veröffentlicht.
+#
+# Parameter:
+# - device: Das EMS, das geantwortet hat.
+def device_succeeded(device):
+    
+    previous = device.breaker.succeeded()
+    
+    if previous is True:
+    
+        return
+    
+    if previous is False:
+    
+        write_log("EMS %s - Responding again, back online", logging.WARNING, device.nr)
+        
+        device.scheduler.reset()
+    
+    publish_status(device)
+
+# Funktion zur Verarbeitung einer fehlgeschlagenen Übertragung
+# Diese Funktion zählt die Fehler des EMS. Wird es dadurch als offline eingestuft, wird dies protokolliert
+# und der Status "offline" veröffentlicht. Beim Beenden wird nichts gezählt.
+#
+# Parameter:
+# - device: Das EMS, das nicht geantwortet hat.
+def device_failed(device):
+    
+    if not running.is_set():
+    
+        return
+    
+    if device.breaker.failed(time.monotonic()):
+    
+        write_log("EMS %s - No valid response after %s failed request(s), marked offline; probing every %ss", logging.ERROR, device.nr, EMS_OFFLINE_AFTER, EMS_OFFLINE_PROBE_INTERVAL)
+        
+        publish_status(device)
+
+# Funktion zur Veröffentlichung des Status eines EMS
+# Diese Funktion veröffentlicht "online" oder "offline" als gespeicherte Nachricht auf `solar/ems/{EMS_Nr}/status`.
+#
+# Parameter:
+# - device: Das EMS.
+def publish_status(device):
+    
+    client.publish(device.status_topic, "online" if device.breaker.online else "offline", retain=True)
+
+# Funktion zur Verarbeitung einer Antwort auf eine Leseanforderung
+# Diese Funktion prüft die Antwort und legt bei Gültigkeit den gesamten Registerblock als ein Eintrag
+# in die Warteschlange.
+#
+# Parameter:
+# - device: Das abgefragte EMS.
+# - response: Der empfangene Antwortrahmen.
+# - frame_base: Der Basisrahmen der Anfrage.
+# - register_address: Die Adresse des ersten angeforderten Registers.
+# - register_count: Die Anzahl der angeforderten Register.
+#
+# Rückgabewert:
+# - response_valid: True, wenn die Antwort gültig war.
+def process_response(device, response, frame_base, register_address, register_count):
+    
+    response_valid, register_values = parse_response(response, frame_base, register_count)
+    
+    if response_valid == True:
+    
+        metrics.poll_succeeded(device)
+        
+        # Merkt sich die Rohwerte für den Vergleich mit späteren Schreibbefehlen.
+        now = time.monotonic()
+        device.registers.update((register_address + i, (value, now)) for i, value in enumerate(register_values))
+        
+        enqueue_data(Reading(device, register_address, register_values, time.time()))
+    
+    return response_valid
+
+# Klasse für einen gelesenen Registerblock
+# Diese Klasse enthält einen vollständigen Registerblock so, wie er empfangen wurde: das EMS, die Adresse
+# des ersten Registers, die Registerwerte als Tupel von Ganzzahlen und den Zeitpunkt des Empfangs.
+# Je Antwortrahmen wird nur ein Objekt erzeugt.
+class Reading:
+
+    __slots__ = ("device", "register_address", "register_values", "timestamp")
+    
+    def __init__(self, device, register_address, register_values, timestamp):
+    
+        self.device = device
+        self.register_address = register_address
+        self.register_values = register_values
+        self.timestamp = timestamp
+
+# Funktion zum Zuordnen eines Registerblocks zu den bekannten Registern
+# Diese Funktion durchläuft die Werte eines Registerblocks und liefert für jedes bekannte Register
+# das Register und seinen Rohwert. Register mit 4 Byte werden aus zwei aufeinanderfolgenden Werten
+# zusammengesetzt; unbekannte Register werden übersprungen.
+#
+# Parameter:
+# - register_address: Die Adresse des ersten Registers im Block.
+# - register_values: Die Werte des Registerblocks.
+#
+# Rückgabewert (je bekanntem Register):
+# - register: Das Register aus der Registerzuordnung.
+# - value: Der Rohwert des Registers.
+def decode_registers(register_address, register_values):
+    
+    register_count = len(register_values)
+    i = 0
+    
+    while i < register_count:
+    
+        register = REGISTER_MAP.get(register_address + i)
+        
+        if register is None:
+        
+            i += 1
+            
+            continue
+        
+        if register.width == 2:
+        
+            # Das niederwertige Register fehlt im Block.
+            if i + 1 >= register_count:
+            
+                break
+            
+            value = (register_values[i] << 16) | register_values[i + 1]
+            
+        else:
+        
+            value = register_values[i]
+        
+        yield register, value
+        
+        i += register.width
+
+# Klasse für die Warteschlange zwischen Lese- und Veröffentlichungs-Thread
+# Diese Klasse hält je EMS und Registerblock nur den neuesten Wert. Ein noch nicht veröffentlichter älterer Wert
+# wird beim Einreihen ersetzt und als verworfen gezählt, sodass die Warteschlange auch bei langsamem oder
+# fehlendem Broker nie mehr als einen Eintrag je Registerblock und EMS enthält. Entnommen wird der am längsten
+# nicht aktualisierte Eintrag zuerst: Überschneiden sich zwei Registerblöcke (z.B. das Zurücklesen nach einem
+# Schreibbefehl und der Abfrageblock mit demselben Register), wird so der neuere Wert zuletzt veröffentlicht.
+# Sie kann aus Threads (get) und aus der asyncio-Laufzeit (get_async) verwendet werden.
+class CoalescingQueue:
+
+    def __init__(self):
+    
+        self.entries = OrderedDict()
+        self.condition = threading.Condition()
+        self.event = None
+        self.closed = False
+        self.woken = False
+        self.dropped = 0
+        self.since = time.monotonic()
+    
+    # Legt einen Eintrag ab und ersetzt einen älteren Eintrag mit demselben Schlüssel.
+    def put(self, key, item):
+    
+        with self.condition:
+        
+            if self.entries.pop(key, None) is not None:
+            
+                self.dropped += 1
+            
+            self.entries[key] = item
+            self.condition.notify()
+        
+        if self.event is not None:
+        
+            self.event.set()
+    
+    # Entnimmt den ältesten Eintrag oder löst queue.Empty aus.
+    def get_nowait(self):
+    
+        with self.condition:
+        
+            if not self.entries:
+            
+                raise queue.Empty
+            
+            return self.entries.popitem(last=False)[1]
+    
+    # Wartet höchstens timeout Sekunden auf einen Eintrag; gibt None zurück, wenn die Warteschlange geschlossen wurde.
+    # Nach wake() oder Ablauf von timeout wird queue.Empty ausgelöst.
+    def get(self, timeout=None):
+    
+        with self.condition:
+        
+            self.condition.wait_for(lambda: self.entries or self.closed or self.woken, timeout)
+            
+            self.woken = False
+            
+            if self.closed:
+            
+                return None
+            
+            if not self.entries:
+            
+                raise queue.Empty
+            
+            return self.entries.popitem(last=False)[1]
+    
+    # Gegenstück zu get() für die asyncio-Laufzeit (benötigt ein asyncio.Event in self.event).
+    async def get_async(self):
+    
+        while True:
+        
+            with self.condition:
+            
+                if self.closed:
+                
+                    return None
+                
+                if self.entries:
+                
+                    self.woken = False
+                    
+                    return self.entries.popitem(last=False)[1]
+                
+                if self.woken:
+                
+                    self.woken = False
+                    
+                    raise queue.Empty
+                
+                self.event.clear()
+            
+            await self.event.wait()
+    
+    # Weckt einen Wartenden auf, ohne einen Eintrag abzulegen.
+    def wake(self):
+    
+        with self.condition:
+        
+            self.woken = True
+            self.condition.notify_all()
+        
+        if self.event is not None:
+        
+            self.event.set()
+    
+    # Schließt die Warteschlange und weckt alle Wartenden auf.
+    def close(self):
+    
+        with self.condition:
+        
+            self.closed = True
+            self.condition.notify_all()
+        
+        if self.event is not None:
+        
+            self.event.set()
+    
+    # Protokolliert die Anzahl der ersetzten Werte, wenn seit dem letzten Bericht `interval` Sekunden vergangen sind.
+    def report(self, interval):
+    
+        now = time.monotonic()
+        elapsed = now - self.since
+        
+        if elapsed < interval:
+        
+            return
+        
+        if self.dropped:
+        
+            write_log("MQTT - Data queue: %s stale value(s) replaced before publishing in %.0fs (%s queued)", logging.INFO, self.dropped, elapsed, len(self.entries))
+        
+        self.dropped = 0
+        self.since = now
+
+# Funktion zum Einreihen von EMS-Daten für die Veröffentlichung
+# Diese Funktion legt einen gelesenen Registerblock in die Warteschlange zum Veröffentlichungs-Thread, ohne zu warten.
+# Ein noch nicht veröffentlichter Block mit denselben Registern desselben EMS wird dabei ersetzt.
+#
+# Parameter:
+# - reading: Der gelesene Registerblock.
+def enqueue_data(reading):
+    
+    data_queue.put((reading.device, reading.register_address, len(reading.register_values)), reading)
+
+# Funktion zum Schreiben von Daten in EMS-Register
+# Diese Funktion erstellt und sendet einen Modbus-Rahmen, um Daten in spezifizierte EMS-Register zu schreiben.
+# Sie versucht, eine gültige Antwort zu erhalten, und wiederholt den Vorgang höchstens `EMS_MAX_RETRIES` Mal
+# sofort (ohne Wartezeit, um den Bus nicht länger zu belegen). Die Antwort wird mit check_write_echo() geprüft.
+#
+# Parameter:
+# - device: Das zu beschreibende EMS.
+# - register_address: Die Adresse des ersten zu beschreibenden Registers.
+# - register_count: Die Anzahl der Register, die beschrieben werden sollen.
+# - register_data: Die Daten, die in die Register geschrieben werden sollen.
+#
+# Rückgabewert:
+# - response_valid: True, wenn das EMS den Schreibbefehl bestätigt hat.
+# - echo_verified: True, wenn die Bestätigung auch den geschriebenen Wert enthält.
+def write_ems(device, register_address, register_count, register_data):
+
+    frame, frame_base = build_frame(device, 0x10, register_address, register_count, register_data)
+    
+    # Sendet den Rahmen und wartet auf eine gültige Antwort.
+    for attempt in range(device.breaker.attempts()):
+    
+        if not running.is_set():
         
-    if len(response) < 10 + (register_count * 2):
+            return False, False
+        
+        response = transfer_frame(device.bus, frame, frame_base)
+        response_valid, echo_verified = check_write_echo(response, frame)
+        
+        if response_valid:
+        
+            device_succeeded(device)
+            
+            return True, echo_verified
+    
+    device_failed(device)
+    
+    return False, False
+
+# Funktion zur Prüfung der Antwort auf einen Schreibbefehl
+# Das EMS bestätigt einen Schreibbefehl (0x10) mit einem Echo, dessen CRC-Prüfsumme bereits der FrameDecoder
+# geprüft hat. Gültig ist das Echo nur, wenn Geräteadresse, Funktionscode, Registeradresse und Anzahl mit dem
+# gesendeten Rahmen übereinstimmen. Enthält es zusätzlich genau die geschriebenen Daten, ist der Wert bestätigt;
+# ein Echo ohne oder mit abweichenden Daten ist gültig, erfordert aber ein Zurücklesen.
+#
+# Parameter:
+# - response: Der empfangene Antwortrahmen.
+# - frame: Der gesendete Schreibrahmen inklusive CRC.
+#
+# Rückgabewert:
+# - response_valid: True, wenn das Echo zum Schreibbefehl gehört.
+# - echo_verified: True, wenn das Echo den geschriebenen Wert bestätigt.
+def check_write_echo(response, frame):
+    
+    if not response or response[:8] != frame[:8]:
+    
+        return False, False
+    
+    return True, response == frame
+
+# Funktion zur Prüfung, ob ein Schreibbefehl überflüssig ist
+# Diese Funktion vergleicht den zu schreibenden Wert mit dem zuletzt gelesenen Wert des Registers. Der Wert gilt
+# nur als bekannt, wenn er höchstens `EMS_WRITE_SKIP_MAX_AGE` Sekunden alt ist.
+#
+# Parameter:
+# - device: Das zu beschreibende EMS.
+# - register_address: Die Adresse des Registers.
+# - value: Der zu schreibende Wert.
+#
+# Rückgabewert:
+# - redundant: True, wenn das Register bereits den Wert hat.
+def write_is_redundant(device, register_address, value):
+    
+    cached = device.registers.get(register_address)
+    
+    return cached is not None and cached[0] == value and time.monotonic() - cached[1] <= EMS_WRITE_SKIP_MAX_AGE
+
+# Funktion zur Übernahme eines bestätigten Schreibbefehls
+# Diese Funktion merkt sich den geschriebenen Wert und legt ihn zur Veröffentlichung in die Warteschlange,
+# sodass kein Zurücklesen nötig ist.
+#
+# Parameter:
+# - device: Das beschriebene EMS.
+# - register_address: Die Adresse des Registers.
+# - value: Der geschriebene Wert.
+def write_confirmed(device, register_address, value):
+    
+    device.registers[register_address] = (value, time.monotonic())
+    
+    enqueue_data(Reading(device, register_address, (value,), time.time()))
+
+################################################################################
+# Funktion zur Ermittlung des Struct-Formats für einen Registerblock
+# Diese Funktion liefert ein vorkompiliertes Struct-Objekt, das register_count Big-Endian-Register
+# in einem Aufruf dekodiert. Die Objekte werden je Registeranzahl nur einmal erzeugt.
+#
+# Parameter:
+# - register_count: Die Anzahl der Register.
+#
+# Rückgabewert:
+# - register_struct: Das Struct-Objekt für den Registerblock.
+def register_struct(register_count):
+    
+    register_struct = REGISTER_STRUCTS.get(register_count)
+    
+    if register_struct is None:
+    
+        register_struct = struct.Struct(f'>{register_count}H')
+        REGISTER_STRUCTS[register_count] = register_struct
+    
+    return register_struct
+
+REGISTER_STRUCTS = {}
+
+# Funktion zur Analyse und Validierung einer Modbus-Antwort
+# Diese Funktion prüft die Länge und Gültigkeit der empfangenen Antwort und dekodiert alle Registerwerte
+# in einem Schritt direkt aus dem Empfangspuffer (ohne Kopien). Die CRC-Prüfsumme hat bereits der
+# FrameDecoder geprüft.
+#
+# Parameter:
+# - response: Der empfangene Modbus-Antwortrahmen als Byte-Array.
+# - frame_base: Der Basisrahmen der gesendeten Nachricht, gegen den die Antwort validiert wird.
+# - register_count: Die Anzahl der Register, deren Werte extrahiert werden sollen.
+#
+# Rückgabewert:
+# - response_valid: Ein boolescher Wert, der angibt, ob die Antwort gültig ist (True) oder nicht (False).
+# - register_values: Ein Tupel der extrahierten Registerwerte.
+def parse_response(response, frame_base, register_count):
+   
+    response_valid = True
+    register_values = ()
+    frame_length = 10 + (register_count * 2)
+    started = time.perf_counter()
+    
+    # Sicht auf den Empfangspuffer, auf der alle weiteren Schritte ohne Kopie arbeiten.
+    view = memoryview(response)[:frame_length]
+    
+    # Überprüft die Länge der Antwort.
+    if len(view) < frame_length:
     
         response_valid = False
         
-        write_log(f"EMS - Response frame: Lenght is to short!", logging.DEBUG)
+        write_log("EMS - Response frame: Lenght is to short!", logging.DEBUG)
         
-    elif frame_base != response_base:
+    elif view[:8] != frame_base:
     
         response_valid = False
         
-        write_log(f"EMS - Response frame: Isn't valid!", logging.DEBUG)
+        write_log("EMS - Response frame: Isn't valid!", logging.DEBUG)
+        
+        metrics.inc("ems_header_mismatches_total")
+        
+    else:
+    
+        # Extrahiert alle Registerwerte mit einem Aufruf.
+        register_values = register_struct(register_count).unpack_from(view, 8)
+    
+    stage_timer.add("decode", started)
+    
+    # Gibt die Gültigkeit der Antwort und die Registerwerte zurück
+    return response_valid, register_values
+
+# Beschreibung eines Registers in der Registerzuordnung.
+Register = namedtuple("Register", ["address", "name", "width", "sign_bit", "scale", "labels", "deadband", "deadband_percent"])
+
+# Funktion zum Erstellen der Registerzuordnung
+# Diese Funktion erstellt aus der Tabelle `EMS_REGISTERS` einmalig ein Wörterbuch, das jeder Registeradresse
+# ihre Beschreibung inklusive Totband aus `MQTT_DEADBANDS` zuordnet. Die MQTT-Themen erstellt jedes EMS selbst.
+# Ein Totband als Zahl ist absolut, als Zeichenkette mit "%" relativ zum zuletzt veröffentlichten Wert.
+#
+# Parameter:
+# - registers: Die Tabelle der Register.
+#
+# Rückgabewert:
+# - register_map: Ein Wörterbuch Adresse -> Register.
+def build_register_map(registers):
+    
+    register_map = {}
+    
+    for address, name, width, signed, scale, labels in registers:
+    
+        sign_bit = (1 << (16 * width - 1)) if signed else 0
+        deadband = MQTT_DEADBANDS.get(name, 0)
+        deadband_percent = 0
+        
+        if isinstance(deadband, str) and deadband.endswith("%"):
+        
+            deadband_percent = float(deadband[:-1])
+            deadband = 0
+        
+        register_map[address] = Register(address, name, width, sign_bit, scale, labels, deadband, deadband_percent)
+    
+    return register_map
+
+REGISTER_MAP = build_register_map(EMS_REGISTERS)
+
+# Funktion zur Planung der Busabfragen
+# Diese Funktion ermittelt aus `EMS_POLL_BLOCKS` die tatsächlich benötigten Register und fasst sie zu
+# möglichst wenigen Leseanforderungen zusammen. Jedes bekannte Register erhält das kürzeste Intervall aller
+# Blöcke, die es enthalten, sodass sich überschneidende Blöcke nichts doppelt lesen. Register mit gleichem
+# Intervall werden gemeinsam geplant.
+#
+# Parameter:
+# - poll_blocks: Die konfigurierten Registerblöcke (Startadresse, Anzahl, Intervall, Beschreibung).
+# - register_map: Die Registerzuordnung.
+#
+# Rückgabewert:
+# - plan: Die geplanten Leseanforderungen im Format von `EMS_POLL_BLOCKS`.
+def plan_poll_blocks(poll_blocks, register_map):
+    
+    periods = {}
+    
+    for register_address, register_count, period, name in poll_blocks:
+    
+        for register in register_map.values():
+        
+            if register_address <= register.address and register.address + register.width <= register_address + register_count:
+            
+                periods[register.address] = min(period, periods.get(register.address, period))
+    
+    plan = []
+    
+    for period in sorted(set(periods.values())):
+    
+        registers = sorted((register_map[address] for address, register_period in periods.items() if register_period == period), key=lambda register: register.address)
+        plan.extend(plan_transactions(registers, period))
+    
+    return plan
+
+# Funktion zur Aufteilung von Registern auf Leseanforderungen
+# Diese Funktion sucht die günstigste Aufteilung sortierter Register auf zusammenhängende Leseanforderungen
+# (dynamische Programmierung). Eine Anfrage kostet `EMS_REQUEST_OVERHEAD` plus 2 Byte je gelesenem Register,
+# sodass kleine Lücken mitgelesen und große Lücken auf eine weitere Anfrage aufgeteilt werden. Keine Anfrage
+# umfasst mehr als `EMS_MAX_REGISTER_COUNT` Register; Register mit 4 Byte werden nie geteilt.
+#
+# Parameter:
+# - registers: Die nach Adresse sortierten Register.
+# - period: Das Abfrageintervall der Register.
+#
+# Rückgabewert:
+# - blocks: Die Leseanforderungen (Startadresse, Anzahl, Intervall, Beschreibung).
+def plan_transactions(registers, period):
+    
+    # cost[j]: geringste Kosten für die ersten j Register, first[j]: erstes Register der letzten Anfrage.
+    cost = [0] + [float("inf")] * len(registers)
+    first = [0] * (len(registers) + 1)
+    
+    for j in range(1, len(registers) + 1):
+    
+        end = registers[j - 1].address + registers[j - 1].width
+        
+        for i in range(j - 1, -1, -1):
+        
+            register_count = end - registers[i].address
+            
+            if register_count > EMS_MAX_REGISTER_COUNT:
+            
+                break
+            
+            total = cost[i] + EMS_REQUEST_OVERHEAD + 2 * register_count
+            
+            if total < cost[j]:
+            
+                cost[j] = total
+                first[j] = i
+    
+    blocks = []
+    j = len(registers)
+    
+    while j > 0:
+    
+        i = first[j]
+        start = registers[i].address
+        end = registers[j - 1].address + registers[j - 1].width
+        
+        blocks.append((start, end - start, period, f"{registers[i].name} - {registers[j - 1].name}"))
+        
+        j = i
+    
+    return blocks[::-1]
+
+EMS_POLL_PLAN = plan_poll_blocks(EMS_POLL_BLOCKS, REGISTER_MAP)
+
+# Funktion zur Interpretation und Umwandlung von EMS-Registerwerten
+# Diese Funktion interpretiert die Werte von EMS-Registern anhand der Registerzuordnung und wandelt sie
+# in lesbare oder anderweitig nützliche Formate um.
+#
+# Parameter:
+# - register: Das Register aus der Registerzuordnung.
+# - value: Der Rohwert des Registers.
+#
+# Rückgabewert:
+# - parsed_value: Der interpretierte und umgewandelte Wert.
+def ems_parse_value(register, value):
+    
+    # Interpretiert den Wert anhand der Registerbeschreibung.
+    if register.labels is not None:
+    
+        parsed_value = register.labels.get(value, register.labels.get(None))
+        
+    else:
+    
+        if register.sign_bit and value >= register.sign_bit:
+        
+            value -= register.sign_bit << 1
+        
+        parsed_value = value / register.scale
+
+    # Gibt den interpretierten Wert zurück
+    return parsed_value
+
+# Funktion zum Aufbereiten eines gelesenen Registerblocks
+# Diese Funktion ordnet die Werte eines Registerblocks den bekannten Registern zu und interpretiert sie.
+#
+# Parameter:
+# - reading: Der gelesene Registerblock.
+#
+# Rückgabewert:
+# - values: Liste aus Register und interpretiertem Wert je bekanntem Register.
+def convert_reading(reading):
+    
+    started = time.perf_counter()
+    values = [(register, ems_parse_value(register, value)) for register, value in decode_registers(reading.register_address, reading.register_values)]
+    
+    stage_timer.add("convert", started)
+    
+    return values
+
+# Klasse zur Begrenzung der Veröffentlichungsrate (Token-Bucket)
+# Diese Klasse füllt ein Guthaben mit `rate` Nachrichten pro Sekunde bis maximal `burst` Nachrichten auf.
+# Jede Veröffentlichung verbraucht eine Nachricht. Eine Rate von 0 schaltet die Begrenzung ab.
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+    
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.timestamp = time.monotonic()
+    
+    # Verbraucht eine Nachricht und gibt zurück, wie viele Sekunden bis dahin noch zu warten ist (0 = sofort).
+    def take(self):
+    
+        if self.rate <= 0:
+        
+            return 0
+        
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        self.tokens -= 1
+        
+        if self.tokens >= 0:
+        
+            return 0
+        
+        return -self.tokens / self.rate
+
+# Funktion zur Prüfung, ob ein Wert veröffentlicht werden muss
+# Diese Funktion vergleicht einen Wert mit dem zuletzt veröffentlichten Wert desselben Registers.
+# Unveränderte Werte und Änderungen innerhalb des Totbands werden unterdrückt, bis seit der letzten
+# Veröffentlichung `MQTT_HEARTBEAT_INTERVAL` Sekunden vergangen sind.
+#
+# Parameter:
+# - topic: Das MQTT-Thema des Werts.
+# - register: Das Register aus der Registerzuordnung.
+# - parsed_value: Der interpretierte Wert des Registers.
+# - now: Der aktuelle Zeitpunkt (time.monotonic()).
+#
+# Rückgabewert:
+# - publish: True, wenn der Wert veröffentlicht werden soll.
+def should_publish(topic, register, parsed_value, now):
+    
+    if not MQTT_PUBLISH_CHANGES_ONLY:
+    
+        return True
+    
+    last = last_published.get(topic)
+    
+    if last is None:
+    
+        return True
+    
+    last_value, last_time = last
+    
+    # Erzwingt regelmäßig eine erneute Veröffentlichung.
+    if now - last_time >= MQTT_HEARTBEAT_INTERVAL:
+    
+        return True
+    
+    if parsed_value == last_value:
+    
+        return False
+    
+    # Texte und fehlende Werte haben kein Totband.
+    if not isinstance(parsed_value, float) or not isinstance(last_value, float):
+    
+        return True
+    
+    deadband = register.deadband or abs(last_value) * register.deadband_percent / 100
+    
+    return abs(parsed_value - last_value) > deadband
+
+last_published = {}
+
+# Mit Warmstart (EMS_STATE_FILE) werden alle Registerwerte von Anfang an als gespeicherte Nachrichten veröffentlicht,
+# damit der Broker neuen Abonnenten nie einen älteren Wert aus der Sicherung liefert.
+MQTT_RETAIN = bool(EMS_STATE_FILE)
+
+# Funktion zur Veröffentlichung von EMS-Daten auf MQTT-Themen
+# Diese Funktion veröffentlicht interpretierte EMS-Daten auf dem MQTT-Thema des jeweiligen EMS.
+# Die Nachricht wird an die Ausgangswarteschlange des MQTT-Clients übergeben, ohne auf den Versand zu warten.
+# Nur wenn `MQTT_PUBLISH_RATE` gesetzt und das Guthaben aufgebraucht ist, wird bis zur nächsten freien
+# Nachricht gewartet.
+#
+# Parameter:
+# - device: Das EMS, von dem der Wert stammt.
+# - register: Das Register aus der Registerzuordnung.
+# - parsed_value: Der interpretierte und umgewandelte Wert des Registers.
+# - replayed: True für nachgesendete Werte; sie werden ohne Prüfung durch should_publish() veröffentlicht.
+def ems_publish_data(device, register, parsed_value, replayed=False):
+
+    now = time.monotonic()
+    topic = device.topics[register.address] if replayed else publish_topic(device, register, parsed_value, now)
+    
+    if topic:
+    
+        # Wartet nur, wenn die konfigurierte Rate überschritten ist.
+        delay = publish_bucket.take()
+        
+        if delay > 0:
+        
+            time.sleep(delay)
+        
+        mqtt_publish(topic, parsed_value, now)
+
+# Funktion zur Ermittlung des MQTT-Themas für einen Wert
+# Diese Funktion gibt das MQTT-Thema des Registers zurück, wenn der Wert veröffentlicht werden muss.
+#
+# Parameter:
+# - device: Das EMS, von dem der Wert stammt.
+# - register: Das Register aus der Registerzuordnung.
+# - parsed_value: Der interpretierte und umgewandelte Wert des Registers.
+# - now: Der aktuelle Zeitpunkt (time.monotonic()).
+#
+# Rückgabewert:
+# - topic: Das MQTT-Thema oder None, wenn nichts veröffentlicht werden muss.
+def publish_topic(device, register, parsed_value, now):
+    
+    topic = device.topics[register.address]
+    
+    if should_publish(topic, register, parsed_value, now):
+    
+        return topic
+    
+    return None
+
+# Funktion zur Übergabe eines Werts an den MQTT-Client
+# Diese Funktion übergibt die Daten an die Ausgangswarteschlange des MQTT-Clients und merkt sich
+# den veröffentlichten Wert.
+#
+# Parameter:
+# - topic: Das MQTT-Thema.
+# - parsed_value: Der zu veröffentlichende Wert.
+# - now: Der aktuelle Zeitpunkt (time.monotonic()).
+def mqtt_publish(topic, parsed_value, now):
+    
+    started = time.perf_counter()
+    result = client.publish(topic, parsed_value, retain=MQTT_RETAIN)
+    
+    stage_timer.add("mqtt_publish", started)
+    
+    if result.rc != mqtt.MQTT_ERR_SUCCESS:
+    
+        write_log("MQTT - Publishing to %s failed with result code %s", logging.DEBUG, topic, result.rc)
+        
+        metrics.inc("ems_mqtt_publish_failures_total")
+        
+        return
+    
+    # Merkt sich den veröffentlichten Wert für den Vergleich mit dem nächsten Wert.
+    last_published[topic] = (parsed_value, now)
+    
+    metrics.inc("ems_mqtt_published_total")
+    
+    write_log("MQTT - Published to %s: %s", logging.DEBUG, topic, parsed_value)
+
+# Funktion zur Veröffentlichung eines Registerblocks als JSON-Dokument
+# Diese Funktion übernimmt die Werte eines gelesenen Registerblocks in die Zustandsdokumente des EMS und
+# veröffentlicht jedes geänderte Dokument als eine Nachricht (MQTT_PUBLISH_MODE = "json"). Nachgesendete
+# Registerblöcke werden mit replayed_documents() und ihrem Lesezeitpunkt veröffentlicht.
+#
+# Parameter:
+# - reading: Der gelesene Registerblock.
+# - replayed: True für einen nachgesendeten Registerblock.
+def ems_publish_state(reading, replayed=False):
+
+    now = time.monotonic()
+    
+    for block in replayed_documents(reading) if replayed else state_documents(reading, now):
+    
+        # Wartet nur, wenn die konfigurierte Rate überschritten ist.
+        delay = publish_bucket.take()
+        
+        if delay > 0:
+        
+            time.sleep(delay)
+        
+        mqtt_publish_state(reading.device, block, now, reading.timestamp if replayed else None)
+
+# Funktion zur Aktualisierung der Zustandsdokumente eines EMS
+# Diese Funktion überträgt die interpretierten Werte eines gelesenen Registerblocks in jedes Zustandsdokument,
+# dessen Registerbereich sich mit dem gelesenen Block überschneidet (nur die Register innerhalb des Bereichs).
+# Ein Dokument muss veröffentlicht werden, sobald einer der neuen Werte nach `should_publish` veröffentlicht
+# werden muss.
+#
+# Parameter:
+# - reading: Der gelesene Registerblock.
+# - now: Der aktuelle Zeitpunkt (time.monotonic()).
+#
+# Rückgabewert:
+# - blocks: Die zu veröffentlichenden Zustandsdokumente.
+def state_documents(reading, now):
+    
+    device = reading.device
+    start = reading.register_address
+    end = start + len(reading.register_values)
+    values = convert_reading(reading)
+    blocks = []
+    
+    for block in device.state_blocks:
+    
+        block_end = block.register_address + block.register_count
+        
+        if end <= block.register_address or start >= block_end:
+        
+            continue
+        
+        publish = False
+        
+        for register, parsed_value in values:
+        
+            if register.address < block.register_address or register.address + register.width > block_end:
+            
+                continue
+            
+            block.values[register.name] = parsed_value
+            publish = publish or should_publish(device.topics[register.address], register, parsed_value, now)
+        
+        if publish:
+        
+            blocks.append(block)
+    
+    return blocks
+
+# Funktion zur Erstellung der Zustandsdokumente eines nachgesendeten Registerblocks
+# Diese Funktion erstellt für jedes Zustandsdokument, das sich mit dem Block überschneidet, ein eigenes Dokument
+# nur mit den nachgesendeten Werten. Die Zustandsdokumente selbst behalten die aktuellen Werte.
+#
+# Parameter:
+# - reading: Der nachgesendete Registerblock.
+#
+# Rückgabewert:
+# - blocks: Die zu veröffentlichenden Dokumente.
+def replayed_documents(reading):
+    
+    values = convert_reading(reading)
+    blocks = []
+    
+    for block in reading.device.state_blocks:
+    
+        block_end = block.register_address + block.register_count
+        document = StateBlock(block.topic, block.register_address, block.register_count)
+        document.values = {register.name: parsed_value for register, parsed_value in values if register.address >= block.register_address and register.address + register.width <= block_end}
+        
+        if document.values:
+        
+            blocks.append(document)
+    
+    return blocks
+
+# Funktion zur Übergabe eines Zustandsdokuments an den MQTT-Client
+# Diese Funktion übergibt alle bekannten Werte eines Zustandsdokuments als JSON-Objekt (Topic-Name: Wert)
+# an die Ausgangswarteschlange des MQTT-Clients und merkt sich die veröffentlichten Werte je Register.
+# Ein nachgesendetes Dokument enthält zusätzlich den Lesezeitpunkt als `timestamp` (Unix-Zeit).
+#
+# Parameter:
+# - device: Das EMS, zu dem das Dokument gehört.
+# - block: Das Zustandsdokument.
+# - now: Der aktuelle Zeitpunkt (time.monotonic()).
+# - timestamp: Der Lesezeitpunkt eines nachgesendeten Dokuments, sonst None.
+def mqtt_publish_state(device, block, now, timestamp=None):
+    
+    started = time.perf_counter()
+    payload = json.dumps(block.values if timestamp is None else dict(block.values, timestamp=round(timestamp, 3)))
+    result = client.publish(block.topic, payload, retain=MQTT_RETAIN)
+    
+    stage_timer.add("mqtt_publish", started)
+    
+    if result.rc != mqtt.MQTT_ERR_SUCCESS:
+    
+        write_log("MQTT - Publishing to %s failed with result code %s", logging.DEBUG, block.topic, result.rc)
+        
+        metrics.inc("ems_mqtt_publish_failures_total")
+        
+        return
+    
+    for name, parsed_value in block.values.items():
+    
+        last_published[device.topic_prefix + name] = (parsed_value, now)
+    
+    metrics.inc("ems_mqtt_published_total")
+    
+    write_log("MQTT - Published to %s: %s", logging.DEBUG, block.topic, payload)
+
+################################################################################
+#                               Zwischenspeicher                               #
+################################################################################
+# Ist der MQTT-Broker nicht erreichbar, werden die gelesenen Registerblöcke auf der SD-Karte zwischengespeichert
+# (MQTT_SPOOL_DIR) und nach der Wiederverbindung in der ursprünglichen Reihenfolge mit `MQTT_SPOOL_REPLAY_RATE`
+# nachgesendet. Neue Registerblöcke werden währenddessen sofort veröffentlicht; der jeweils neueste wird gemerkt
+# und nach dem Nachsenden erneut veröffentlicht, sodass am Ende kein älterer Wert einen neueren überschreibt.
+
+# Klasse für den Zwischenspeicher während eines Broker-Ausfalls
+# Diese Klasse hängt Registerblöcke als kompakte Binärdatensätze an nummerierte Dateien an (`spool.00000001`, ...).
+# Erreicht eine Datei `segment_size` Bytes, wird eine neue begonnen; überschreiten alle Dateien `max_size` Bytes,
+# wird die älteste verworfen. Eine Datei wird erst gelesen, wenn nichts mehr angehängt wird, und nach dem
+# Nachsenden gelöscht. Dateien eines vorherigen Laufs werden übernommen.
+#
+# Ein Datensatz besteht aus Zeitstempel, Registeradresse, Registeranzahl, Länge der EMS-Nummer, EMS-Nummer,
+# Registerwerten und einer CRC-Prüfsumme, an der ein beim Absturz abgeschnittener Datensatz erkannt wird.
+# Geschrieben wird ohne fsync, um die SD-Karte zu schonen. Alle Zugriffe erfolgen aus dem Veröffentlichungs-Thread.
+class MqttSpool:
+
+    RECORD_HEADER = struct.Struct("<dHBB")
+    
+    def __init__(self, directory, segment_size, max_size, devices):
+    
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.devices = {device.nr: device for device in devices}
+        
+        os.makedirs(directory, exist_ok=True)
+        
+        self.segments = sorted(name for name in os.listdir(directory) if name.startswith("spool.") and name[6:].isdigit())
+        self.size = sum(os.path.getsize(self.path(name)) for name in self.segments)
+        self.sequence = int(self.segments[-1][6:]) if self.segments else 0
+        self.writer = None
+        self.data = None
+        self.offset = 0
+        self.next = None
+        self.superseded = {}
+    
+    def path(self, name):
+    
+        return os.path.join(self.directory, name)
+    
+    # True, solange Registerblöcke auf das Nachsenden warten.
+    def pending(self):
+    
+        return bool(self.segments)
+    
+    # Merkt sich einen während des Nachsendens veröffentlichten Registerblock, um ihn danach erneut zu veröffentlichen.
+    def supersede(self, reading):
+    
+        if self.segments:
+        
+            self.superseded[(reading.device, reading.register_address, len(reading.register_values))] = reading
+    
+    # Hängt einen Registerblock als Datensatz an die aktuelle Datei an.
+    def append(self, reading):
+    
+        nr = reading.device.nr.encode("utf-8")
+        count = len(reading.register_values)
+        record = self.RECORD_HEADER.pack(reading.timestamp, reading.register_address, count, len(nr)) + nr + struct.pack(f"<{count}H", *reading.register_values)
+        record += struct.pack("<H", calculate_crc(record))
+        
+        if self.writer is None or self.writer.tell() + len(record) > self.segment_size:
+        
+            self.rotate()
+        
+        self.writer.write(record)
+        self.writer.flush()
+        self.size += len(record)
+        
+        # Verwirft die ältesten Dateien, bis der Zwischenspeicher wieder in `max_size` passt.
+        while self.size > self.max_size and len(self.segments) > 1:
+        
+            dropped = self.remove_oldest()
+            
+            write_log("MQTT - Spool exceeds %s bytes, dropped the oldest %s bytes", logging.WARNING, self.max_size, dropped)
+            
+            metrics.inc("ems_mqtt_spool_dropped_bytes_total", amount=dropped)
+    
+    # Beginnt eine neue Datei.
+    def rotate(self):
+    
+        self.close()
+        
+        self.sequence += 1
+        name = f"spool.{self.sequence:08d}"
+        
+        self.writer = open(self.path(name), "ab")
+        self.segments.append(name)
+    
+    # Löscht die älteste Datei und gibt ihre Größe zurück.
+    def remove_oldest(self):
+    
+        name = self.segments.pop(0)
+        path = self.path(name)
+        size = os.path.getsize(path)
+        
+        if not self.segments:
+        
+            self.close()
+        
+        os.remove(path)
+        
+        self.size -= size
+        self.data = None
+        self.next = None
+        
+        return size
+    
+    # Gibt den ältesten noch nicht nachgesendeten Registerblock zurück (None, wenn keiner mehr wartet).
+    def peek(self):
+    
+        while self.next is None and self.segments:
+        
+            if self.data is None:
+            
+                # Die aktuelle Datei wird abgeschlossen; neue Registerblöcke kommen in eine neue Datei.
+                if len(self.segments) == 1:
+                
+                    self.close()
+                
+                with open(self.path(self.segments[0]), "rb") as spool_file:
+                
+                    self.data = spool_file.read()
+                
+                self.offset = 0
+            
+            self.next = self.decode()
+            
+            if self.next is None:
+            
+                self.remove_oldest()
+        
+        return self.next[0] if self.next is not None else None
+    
+    # Markiert den zuletzt mit peek() gelieferten Registerblock als nachgesendet.
+    def consume(self):
+    
+        self.offset = self.next[1]
+        self.next = None
+    
+    # Dekodiert den nächsten Datensatz der gelesenen Datei. Datensätze unbekannter EMS werden übersprungen.
+    #
+    # Rückgabewert:
+    # - next: Der Registerblock und das Ende des Datensatzes oder None am Dateiende.
+    def decode(self):
+    
+        header = self.RECORD_HEADER
+        
+        while self.offset + header.size <= len(self.data):
+        
+            timestamp, register_address, count, nr_length = header.unpack_from(self.data, self.offset)
+            start = self.offset + header.size
+            end = start + nr_length + (count * 2) + 2
+            
+            if end > len(self.data) or calculate_crc(self.data[self.offset:end - 2]) != struct.unpack_from("<H", self.data, end - 2)[0]:
+            
+                write_log("MQTT - Spool file %s is damaged after %s bytes, skipping the rest", logging.WARNING, self.segments[0], self.offset)
+                
+                return None
+            
+            device = self.devices.get(self.data[start:start + nr_length].decode("utf-8", "replace"))
+            
+            if device is None:
+            
+                self.offset = end
+                
+                continue
+            
+            register_values = struct.unpack_from(f"<{count}H", self.data, start + nr_length)
+            
+            return Reading(device, register_address, register_values, timestamp), end
+        
+        return None
+    
+    # Schließt die aktuelle Datei.
+    def close(self):
+    
+        if self.writer is not None:
+        
+            self.writer.close()
+            self.writer = None
+
+# Funktion zum Zwischenspeichern eines Registerblocks
+# Diese Funktion legt einen Registerblock im Zwischenspeicher ab, wenn der Broker nicht verbunden ist.
+# Warten bei bestehender Verbindung noch ältere Registerblöcke auf das Nachsenden, wird der Block nur für
+# replay_spool() gemerkt und sofort veröffentlicht.
+#
+# Parameter:
+# - reading: Der gelesene Registerblock.
+#
+# Rückgabewert:
+# - spooled: True, wenn der Registerblock zwischengespeichert wurde und nicht veröffentlicht werden darf.
+def spool_reading(reading):
+    
+    if spool is None:
+    
+        return False
+    
+    if mqtt_connected.is_set():
+    
+        spool.supersede(reading)
+        
+        return False
+    
+    # Ein später zwischengespeicherter Block ist neuer als der gemerkte.
+    spool.superseded.pop((reading.device, reading.register_address, len(reading.register_values)), None)
+    
+    if not spool.pending():
+    
+        write_log("MQTT - Broker unavailable, spooling readings to %s", logging.WARNING, spool.directory)
+    
+    spool.append(reading)
+    
+    metrics.inc("ems_mqtt_spooled_total")
+    
+    return True
+
+# Funktion zur Prüfung, ob nachgesendet werden kann
+#
+# Rückgabewert:
+# - pending: True, wenn der Broker verbunden ist und Registerblöcke im Zwischenspeicher warten.
+def replay_pending():
+    
+    return spool is not None and mqtt_connected.is_set() and spool.pending()
+
+################################################################################
+#                                  Warmstart                                   #
+################################################################################
+# Die zuletzt gelesenen Rohwerte aller EMS werden regelmäßig und beim Beenden in `EMS_STATE_FILE` gesichert.
+# Beim Start werden sie sofort als gespeicherte Nachrichten veröffentlicht, sodass z.B. Einstellungen wie
+# Battery_Capacity nicht erst nach der ersten Abfrage ihres Registerblocks bekannt sind. Gesichert werden
+# die Rohwerte, damit sie auch nach einer Änderung der Registerzuordnung richtig interpretiert werden.
+
+# Klasse für die Sicherung der Registerwerte
+# Diese Klasse schreibt die Rohwerte je EMS als JSON-Datei (EMS-Nummer: {Registeradresse: Wert}) und liest sie
+# beim Start wieder ein. Geschrieben wird zuerst in eine temporäre Datei, die anschließend die alte ersetzt,
+# sodass ein Absturz während des Schreibens die letzte Sicherung nicht beschädigt.
+class RegisterSnapshot:
+
+    def __init__(self, path, interval):
+    
+        self.path = path
+        self.interval = interval
+        self.saved = time.monotonic()
+        self.values = {}
+    
+    # Liest die Sicherung ein und gibt die Anzahl der gesicherten Registerwerte zurück.
+    # Die Werte werden in den Registerspeicher der EMS übernommen (als veraltet, sie unterdrücken also keine
+    # Schreibbefehle), und vollständig gesicherte Abfrageblöcke werden erst nach ihrem Intervall wieder abgefragt. Veröffentlicht werden sie mit take().
+    def load(self, devices):
+    
+        try:
+        
+            with open(self.path, encoding="utf-8") as state_file:
+            
+                state = json.load(state_file)
+            
+        except FileNotFoundError:
+        
+            return 0
+            
+        except (OSError, ValueError) as e:
+        
+            write_log("EMS - Reading register values from %s failed: %s", logging.WARNING, self.path, e)
+            
+            return 0
+        
+        for device in devices:
+        
+            values = {int(address, 16): value for address, value in state.get("ems", {}).get(device.nr, {}).items()}
+            
+            device.registers.update((address, (value, float("-inf"))) for address, value in values.items())
+            
+            if values:
+            
+                self.values[device] = values
+            
+            for block in device.scheduler.blocks:
+            
+                if all(address in values for address in range(block.register_address, block.register_address + block.register_count)):
+                
+                    block.deadline += block.period
+        
+        return sum(len(values) for values in self.values.values())
+    
+    # Fasst aufeinanderfolgende Register zu Blöcken zusammen, damit 4-Byte-Register vollständig bleiben.
+    def readings(self, device, values):
+    
+        readings = []
+        run = []
+        
+        for address in sorted(values) + [None]:
+        
+            if run and address != run[-1] + 1:
+            
+                readings.append(Reading(device, run[0], tuple(values[a] for a in run), time.time()))
+                
+                run = []
+            
+            if address is not None:
+            
+                run.append(address)
+        
+        return readings
+    
+    # Gibt die gesicherten Registerwerte einmalig als Registerblöcke zurück. Register, die seit dem Start
+    # gelesen wurden, entfallen, damit kein älterer Wert einen neueren überschreibt.
+    def take(self):
+    
+        readings = []
+        
+        for device, values in self.values.items():
+        
+            readings += self.readings(device, {address: value for address, value in values.items() if device.registers[address][1] == float("-inf")})
+        
+        self.values = {}
+        
+        return readings
+    
+    # Schreibt die zuletzt gelesenen Rohwerte aller EMS.
+    def save(self, devices):
+    
+        state = {device.nr: {f"{address:04X}": value for address, (value, timestamp) in sorted(dict(device.registers).items())} for device in devices}
+        temporary_path = self.path + ".tmp"
+        
+        try:
+        
+            with open(temporary_path, "w", encoding="utf-8") as state_file:
+            
+                json.dump({"timestamp": time.time(), "ems": state}, state_file)
+            
+            os.replace(temporary_path, self.path)
+            
+        except OSError as e:
+        
+            write_log("EMS - Saving register values to %s failed: %s", logging.ERROR, self.path, e)
+        
+        self.saved = time.monotonic()
+    
+    # Sichert die Rohwerte, wenn seit der letzten Sicherung `interval` Sekunden vergangen sind.
+    def save_periodically(self, devices):
+    
+        if time.monotonic() - self.saved >= self.interval:
+        
+            self.save(devices)
+
+################################################################################
+# Klasse für einen regelmäßig abgefragten Registerblock
+# Diese Klasse enthält die Parameter einer geplanten Abfrage aus `EMS_POLL_PLAN` sowie den Zeitpunkt,
+# zu dem er spätestens wieder abgefragt werden soll.
+class PollBlock:
+
+    def __init__(self, register_address, register_count, period, name, now):
+    
+        self.register_address = register_address
+        self.register_count = register_count
+        self.period = period
+        self.name = name
+        self.deadline = now
+        self.behind = False
+        self.lost = 0.0
+
+# Klasse zur Planung der Registerabfragen
+# Diese Klasse wählt immer den Registerblock mit der frühesten Frist aus (Earliest Deadline First).
+# Nach einer Abfrage wird die nächste Frist um das Intervall des Blocks verschoben. Liegt ein Block
+# um mehr als ein ganzes Intervall zurück, wird dies einmalig protokolliert und die Frist neu gesetzt,
+# damit sich keine Abfragen aufstauen. Zeit, die der Bus seit der letzten Abfrage des Blocks mit
+# fehlgeschlagenen Versuchen (z.B. an ein ausgefallenes EMS) verbracht hat, zählt nicht als Verzug.
+class PollScheduler:
+
+    def __init__(self, poll_blocks, label):
+    
+        now = time.monotonic()
+        
+        self.label = label
+        self.blocks = [PollBlock(register_address, register_count, period, name, now) for register_address, register_count, period, name in poll_blocks]
+    
+    # Gibt den Block mit der frühesten Frist zurück.
+    def next_block(self):
+    
+        return min(self.blocks, key=lambda block: block.deadline)
+    
+    # Plant alle Blöcke sofort neu ein, z.B. wenn ein EMS wieder antwortet.
+    def reset(self):
+    
+        now = time.monotonic()
+        
+        for block in self.blocks:
+        
+            block.deadline = now
+            block.behind = False
+    
+    # Setzt die nächste Frist eines abgefragten Blocks; lost ist der Zählerstand von BusStats.lost.
+    def complete(self, block, lost):
+    
+        now = time.monotonic()
+        lateness = now - block.deadline - (lost - block.lost)
+        
+        block.lost = lost
+        
+        if lateness > block.period:
+        
+            if not block.behind:
+            
+                write_log("EMS %s - Poll block %s (0x%04X) is falling behind by %.1fs (period %ss)", logging.WARNING, self.label, block.name, block.register_address, lateness, block.period)
+                
+                block.behind = True
+            
+            block.deadline = now + block.period
+            
+        else:
+        
+            if block.behind:
+            
+                write_log("EMS %s - Poll block %s (0x%04X) caught up", logging.INFO, self.label, block.name, block.register_address)
+                
+                block.behind = False
+            
+            block.deadline += block.period
+
+# Klasse für ein JSON-Zustandsdokument
+# Diese Klasse enthält das MQTT-Thema und den Registerbereich eines Blocks aus `EMS_POLL_BLOCKS` sowie
+# die zuletzt gelesenen, interpretierten Werte aller Register in diesem Bereich (Topic-Name: Wert).
+class StateBlock:
+
+    def __init__(self, topic, register_address, register_count):
+    
+        self.topic = topic
+        self.register_address = register_address
+        self.register_count = register_count
+        self.values = {}
+
+# Klasse zur Ausfallerkennung eines EMS (Circuit Breaker)
+# Diese Klasse zählt aufeinanderfolgende fehlgeschlagene Anfragen. Ab `EMS_OFFLINE_AFTER` Fehlern gilt das EMS
+# als offline; es wird dann nur noch alle `EMS_OFFLINE_PROBE_INTERVAL` Sekunden mit einem einzelnen Versuch
+# geprüft, bis es wieder antwortet. Vor der ersten Antwort ist der Zustand unbekannt (None).
+# Nach jedem fehlgeschlagenen Versuch wird das EMS bis `retry_at` zurückgestellt (siehe next_poll()); die
+# Wartezeit wächst mit der Anzahl der fehlgeschlagenen Versuche in Folge (`missed`).
+class CircuitBreaker:
+
+    def __init__(self):
+    
+        self.failures = 0
+        self.attempt = 0
+        self.missed = 0
+        self.online = None
+        self.retry_at = 0.0
+    
+    # Gibt die Anzahl der Versuche je Anfrage zurück.
+    def attempts(self):
+    
+        return 1 if self.online is False else 1 + EMS_MAX_RETRIES
+    
+    # Erfasst eine gültige Antwort und gibt den vorherigen Zustand zurück.
+    def succeeded(self):
+    
+        previous = self.online
+        
+        self.failures = 0
+        self.attempt = 0
+        self.missed = 0
+        self.online = True
+        
+        return previous
+    
+    # Erfasst einen fehlgeschlagenen Leseversuch; gibt True zurück, wenn die Anfrage nach der Wartezeit
+    # wiederholt wird, und False, wenn alle Versuche verbraucht sind.
+    def retry(self, now):
+    
+        self.attempt += 1
+        
+        if self.attempt >= self.attempts():
+        
+            self.attempt = 0
+            
+            return False
+        
+        self.missed += 1
+        self.retry_at = now + retry_delay(self.missed)
+        
+        return True
+    
+    # Erfasst eine fehlgeschlagene Anfrage; gibt True zurück, wenn das EMS dadurch offline geht.
+    def failed(self, now):
+    
+        self.failures += 1
+        self.missed += 1
+        
+        if self.online is not False and self.failures >= EMS_OFFLINE_AFTER:
+        
+            self.online = False
+            self.retry_at = now + EMS_OFFLINE_PROBE_INTERVAL
+            
+            return True
+        
+        self.retry_at = now + (EMS_OFFLINE_PROBE_INTERVAL if self.online is False else retry_delay(self.missed))
+        
+        return False
+
+# Klasse für ein EMS am RS485-Bus
+# Diese Klasse enthält den Bus, die Geräteadresse, die EMS-Nummer mit den daraus erstellten MQTT-Themen,
+# die JSON-Zustandsdokumente, die zuletzt gelesenen Rohwerte je Register (Wert, Zeitpunkt), die Ausfallerkennung
+# und den eigenen PollScheduler des Geräts.
+class EmsDevice:
+
+    def __init__(self, bus, address, nr):
+    
+        self.bus = bus
+        self.address = address
+        self.nr = nr
+        self.topic_prefix = f"solar/ems/{nr}/"
+        self.topics = {register.address: self.topic_prefix + register.name for register in REGISTER_MAP.values()}
+        self.state_blocks = [StateBlock(f"{self.topic_prefix}state/{register_address:04X}", register_address, register_count) for register_address, register_count, period, name in EMS_POLL_BLOCKS]
+        self.status_topic = self.topic_prefix + "status"
+        self.registers = {}
+        self.breaker = CircuitBreaker()
+        self.scheduler = PollScheduler(EMS_POLL_PLAN, nr)
+
+# Klasse zur Erfassung der Busauslastung
+# Diese Klasse summiert die Zeit, in der der Bus durch Anfragen und Antworten belegt ist, und berechnet
+# daraus die Auslastung seit dem letzten Bericht. `lost` summiert fortlaufend die Zeit fehlgeschlagener
+# Leseversuche (siehe PollScheduler.complete()).
+class BusStats:
+
+    def __init__(self, port, device_count):
+    
+        self.port = port
+        self.device_count = device_count
+        self.busy = 0.0
+        self.transactions = 0
+        self.since = time.monotonic()
+        self.lost = 0.0
+    
+    # Erfasst eine Übertragung mit ihrer Dauer in Sekunden.
+    def add(self, duration):
+    
+        self.busy += duration
+        self.transactions += 1
+    
+    # Protokolliert die Auslastung, wenn seit dem letzten Bericht `interval` Sekunden vergangen sind.
+    def report(self, interval):
+    
+        now = time.monotonic()
+        elapsed = now - self.since
+        
+        if elapsed < interval:
+        
+            return
+        
+        utilisation = 100 * self.busy / elapsed
+        
+        write_log("EMS - Bus utilisation on %s: %.1f%% (%s transactions in %.0fs, %s device(s))", logging.INFO, self.port, utilisation, self.transactions, elapsed, self.device_count)
+        
+        self.busy = 0.0
+        self.transactions = 0
+        self.since = now
+
+# Klasse für einen RS485-Adapter
+# Diese Klasse enthält die serielle Schnittstelle eines Adapters, ihren Rahmendecoder, die Busauslastung,
+# das Weck-Ereignis des zugehörigen Lese-Threads und die angeschlossenen EMS.
+class RS485Bus:
+
+    def __init__(self, port, device_list):
+    
+        self.port = port
+        self.ser = None
+        self.decoder = FrameDecoder()
+        self.wakeup = threading.Event()
+        self.devices = [EmsDevice(self, address, nr) for address, nr in device_list]
+        self.stats = BusStats(port, len(self.devices))
+    
+    # Öffnet die serielle Schnittstelle, falls sie noch nicht geöffnet ist. Neben Gerätepfaden sind auch
+    # pyserial-URLs wie "socket://localhost:5020" (z.B. für ems_simulator.py) möglich.
+    def open(self):
+    
+        if self.ser is None:
+        
+            self.ser = serial.serial_for_url(self.port, baudrate=RS485_BAUD_RATE, parity=RS485_PARITY, stopbits=RS485_STOPBITS, bytesize=RS485_BYTESIZE, timeout=RS485_TIMEOUT, inter_byte_timeout=inter_byte_timeout())
+            
+            write_log("EMS - Opened %s", logging.INFO, self.port)
+    
+    # Schließt die serielle Schnittstelle und ignoriert Fehler eines bereits entfernten Adapters.
+    def close(self):
+    
+        if self.ser is not None:
+        
+            try:
+            
+                self.ser.close()
+                
+            except (serial.SerialException, OSError):
+            
+                pass
+            
+            self.ser = None
+
+# Funktion zur Auswahl der nächsten Abfrage eines Busses
+# Diese Funktion wählt über alle EMS eines Busses den Registerblock mit der frühesten Frist. Ein EMS, dessen
+# letzter Versuch fehlgeschlagen ist, wird frühestens nach seiner Wartezeit bzw. Prüfzeit berücksichtigt, sodass
+# die übrigen EMS ihre Abfrageintervalle einhalten.
+#
+# Parameter:
+# - bus: Der RS485-Bus.
+#
+# Rückgabewert:
+# - device: Das abzufragende EMS.
+# - block: Der abzufragende Registerblock.
+# - delay: Die Zeit in Sekunden bis zur Frist (kleiner oder gleich 0 = sofort).
+def next_poll(bus):
+    
+    polls = []
+    
+    for device in bus.devices:
+    
+        block = device.scheduler.next_block()
+        due = max(block.deadline, device.breaker.retry_at)
+        
+        polls.append((due, device, block))
+    
+    due, device, block = min(polls, key=lambda poll: poll[0])
+    
+    return device, block, due - time.monotonic()
+
+################################################################################
+#                                   Metriken                                   #
+################################################################################
+# Optionale Schnittstelle für Prometheus/OpenMetrics (METRICS_PORT): Antwortzeiten je Registerblock,
+# Übertragungsfehler, Wiederholungen, Füllstand der Warteschlange und des Zwischenspeichers, veröffentlichte
+# Nachrichten und das Alter der letzten erfolgreichen Abfrage je EMS. Die Werte werden immer erfasst; der HTTP-Server läuft nur, wenn
+# ein Port gesetzt ist.
+METRIC_DESCRIPTIONS = {
+    "ems_request_duration_seconds":     ("histogram", "Round-trip time of read requests per EMS and register block"),
+    "ems_request_retries_total":        ("counter",   "Repeated read requests after a missing or invalid response"),
+    "ems_crc_errors_total":             ("counter",   "Response frames with a wrong CRC"),
+    "ems_header_mismatches_total":      ("counter",   "Response frames that do not match the request"),
+    "ems_mqtt_published_total":         ("counter",   "Messages handed to the MQTT client"),
+    "ems_mqtt_publish_failures_total":  ("counter",   "Messages rejected by the MQTT client"),
+    "ems_mqtt_spooled_total":           ("counter",   "Register blocks written to the spool while the broker was unavailable"),
+    "ems_mqtt_replayed_total":          ("counter",   "Register blocks replayed from the spool"),
+    "ems_mqtt_spool_dropped_bytes_total": ("counter", "Spool bytes dropped because the spool was full"),
+    "ems_mqtt_spool_bytes":             ("gauge",     "Bytes waiting in the spool"),
+    "ems_data_queue_depth":             ("gauge",     "Register blocks waiting to be published"),
+    "ems_last_poll_age_seconds":        ("gauge",     "Seconds since the last valid response per EMS"),
+    "ems_device_online":                ("gauge",     "1 if the EMS responds, 0 if it is marked offline"),
+}
+
+# Klasse zur Erfassung der Metriken
+# Diese Klasse zählt Ereignisse und Antwortzeiten aus den Lese- und Veröffentlichungs-Threads. Jede Reihe
+# wird durch ihren Namen und ein Tupel von Label-Paaren bestimmt. Zugriffe sind durch eine Sperre geschützt.
+class Metrics:
+
+    def __init__(self, buckets):
+    
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {(name, ()): 0 for name in ("ems_crc_errors_total", "ems_header_mismatches_total", "ems_mqtt_published_total", "ems_mqtt_publish_failures_total")}
+        self.histograms = {}
+        self.last_poll = {}
+    
+    # Erhöht einen Zähler.
+    def inc(self, name, labels=(), amount=1):
+    
+        with self.lock:
+        
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + amount
+    
+    # Erfasst einen Messwert in einem Histogramm (kumulierte Bucket-Zähler, Summe, Anzahl).
+    def observe(self, name, labels, value):
+    
+        with self.lock:
+        
+            histogram = self.histograms.get((name, labels))
+            
+            if histogram is None:
+            
+                histogram = self.histograms[name, labels] = [0] * (len(self.buckets) + 2)
+            
+            for i, bound in enumerate(self.buckets):
+            
+                if value <= bound:
+                
+                    histogram[i] += 1
+            
+            histogram[-2] += value
+            histogram[-1] += 1
+    
+    # Merkt sich den Zeitpunkt der letzten gültigen Antwort eines EMS.
+    def poll_succeeded(self, device):
+    
+        self.last_poll[device.nr] = time.monotonic()
+    
+    # Erstellt die Ausgabe im Textformat von Prometheus.
+    def render(self):
+    
+        now = time.monotonic()
+        series = {name: [] for name in METRIC_DESCRIPTIONS}
+        
+        with self.lock:
+        
+            for (name, labels), value in self.counters.items():
+            
+                series[name].append((name, labels, value))
+            
+            for (name, labels), histogram in self.histograms.items():
+            
+                for bound, count in zip(self.buckets, histogram):
+                
+                    series[name].append((name + "_bucket", labels + (("le", str(bound)),), count))
+                
+                series[name].append((name + "_bucket", labels + (("le", "+Inf"),), histogram[-1]))
+                series[name].append((name + "_sum", labels, histogram[-2]))
+                series[name].append((name + "_count", labels, histogram[-1]))
+        
+        series["ems_data_queue_depth"].append(("ems_data_queue_depth", (), len(data_queue.entries)))
+        
+        if spool is not None:
+        
+            series["ems_mqtt_spool_bytes"].append(("ems_mqtt_spool_bytes", (), spool.size))
+        
+        for device in devices:
+        
+            if device.breaker.online is not None:
+            
+                series["ems_device_online"].append(("ems_device_online", (("ems", device.nr),), int(device.breaker.online)))
+            
+            if device.nr in self.last_poll:
+            
+                series["ems_last_poll_age_seconds"].append(("ems_last_poll_age_seconds", (("ems", device.nr),), now - self.last_poll[device.nr]))
+        
+        lines = []
+        
+        for name, (metric_type, description) in METRIC_DESCRIPTIONS.items():
+        
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            
+            for sample_name, labels, value in series[name]:
+            
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                
+                lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+        
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_BUCKETS)
+
+# Funktion zum Erstellen der Labels einer Leseanforderung
+#
+# Parameter:
+# - device: Das abgefragte EMS.
+# - register_address: Die Adresse des ersten Registers.
+#
+# Rückgabewert:
+# - labels: Die Label-Paare für EMS und Registerblock.
+def request_labels(device, register_address):
+    
+    return (("ems", device.nr), ("block", f"0x{register_address:04X}"))
+
+# Klasse für die Anfragen an den Metrik-Server
+# Diese Klasse beantwortet GET /metrics mit den aktuellen Metriken; alle anderen Pfade mit 404.
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+    
+        if self.path.split("?")[0] != "/metrics":
+        
+            self.send_error(404)
+            
+            return
+        
+        body = metrics.render().encode("utf-8")
+        
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    # Abfragen des Servers werden nicht protokolliert.
+    def log_message(self, format, *args):
+    
+        pass
+
+# Funktion zum Start des Metrik-Servers
+# Diese Funktion startet den HTTP-Server für die Metriken in einem eigenen Hintergrund-Thread.
+#
+# Parameter:
+# - port: Der TCP-Port des Servers.
+#
+# Rückgabewert:
+# - server: Der gestartete Server, der beim Beenden mit shutdown() gestoppt wird.
+def start_metrics_server(port):
+    
+    server = http.server.ThreadingHTTPServer(("", port), MetricsHandler)
+    
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    
+    write_log("EMS - Serving metrics on port %s", logging.INFO, port)
+    
+    return server
+
+################################################################################
+#                                Laufzeitmessung                               #
+################################################################################
+# Optionale Messung der Verarbeitungsschritte (PROFILE_STAGES): Rahmen erstellen, CRC, serielles Schreiben,
+# Zeit bis zum ersten Antwortbyte, Empfang des ganzen Rahmens, Dekodieren, Wartezeit zwischen Lesen und
+# Veröffentlichen, Aufbereiten der Werte und Übergabe an den MQTT-Client. Daran lässt sich ablesen, ob der Bus,
+# die CPU oder der Broker zum Engpass wird. Mit PROFILE_OUTPUT wird zusätzlich jeder Thread mit cProfile
+# ausgeführt; die Dateien lassen sich z.B. mit snakeviz, gprof2dot oder flameprof auswerten.
+
+# Klasse zur Erfassung der Dauer einzelner Verarbeitungsschritte
+# Diese Klasse summiert Anzahl, Gesamtdauer und Höchstwert je Schritt und protokolliert sie regelmäßig.
+# Ist die Messung abgeschaltet, kehrt add() sofort zurück.
+class StageTimer:
+
+    def __init__(self, enabled):
+    
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.since = time.monotonic()
+    
+    # Erfasst die Dauer eines Schritts seit `started` (time.perf_counter()).
+    def add(self, stage, started):
+    
+        if self.enabled:
+        
+            self.record(stage, time.perf_counter() - started)
+    
+    # Erfasst die Dauer eines Schritts seit `started` (time.time(), z.B. über Threads hinweg).
+    def add_wall(self, stage, started):
+    
+        if self.enabled:
+        
+            self.record(stage, time.time() - started)
+    
+    # Addiert eine gemessene Dauer zum Schritt.
+    def record(self, stage, duration):
+    
+        with self.lock:
+        
+            totals = self.stages.get(stage)
+            
+            if totals is None:
+            
+                totals = self.stages[stage] = [0, 0.0, 0.0]
+            
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+    
+    # Protokolliert je Schritt Anzahl, Mittelwert und Höchstwert, wenn seit dem letzten Bericht `interval` Sekunden vergangen sind.
+    def report(self, interval):
+    
+        now = time.monotonic()
+        elapsed = now - self.since
+        
+        if not self.enabled or elapsed < interval:
+        
+            return
+        
+        with self.lock:
+        
+            stages = self.stages
+            self.stages = {}
+            self.since = now
+        
+        for stage, (count, total, longest) in stages.items():
+        
+            write_log("EMS - Stage %s: %s call(s) in %.0fs, avg %.3fms, max %.3fms", logging.INFO, stage, count, elapsed, 1000 * total / count, 1000 * longest)
+
+stage_timer = StageTimer(PROFILE_STAGES)
+
+# Funktion zum Ausführen einer Aufgabe mit cProfile
+# Diese Funktion führt eine Thread-Funktion oder die asyncio-Laufzeit aus. Ist `PROFILE_OUTPUT` gesetzt, läuft sie
+# unter cProfile, und die Messdaten werden beim Beenden nach `<PROFILE_OUTPUT>.<name>.prof` geschrieben.
+#
+# Parameter:
+# - name: Der Name der Aufgabe für den Dateinamen.
+# - target: Die auszuführende Funktion.
+# - args: Die Argumente der Funktion.
+def run_profiled(name, target, *args):
+    
+    if not PROFILE_OUTPUT:
+    
+        return target(*args)
+    
+    profiler = cProfile.Profile()
+    
+    try:
+    
+        return profiler.runcall(target, *args)
+        
+    finally:
+    
+        filename = f"{PROFILE_OUTPUT}.{name}.prof"
+        
+        profiler.dump_stats(filename)
+        
+        write_log("EMS - Profile written to %s", logging.INFO, filename)
+
+################################################################################
+#                                   Threads                                    #
+################################################################################
+
+# Thread zur Überwachung und Steuerung von EMS-Registerwerten
+# Für jeden RS485-Adapter läuft ein eigener Thread, der als einziger auf diesen Bus zugreift und alle dort
+# angeschlossenen EMS bedient. Er führt anstehende Schreibbefehle aus der Befehlswarteschlange vor jeder Busabfrage aus.
+# Die regelmäßigen Leseanforderungen plant jedes EMS mit seinem eigenen PollScheduler; es wird der Block
+# mit der frühesten Frist über alle EMS gelesen, sodass sich die Geräte gleichmäßig abwechseln.
+# Fällt der Adapter aus, wird er nach `RS485_REOPEN_DELAY` Sekunden erneut geöffnet, ohne die anderen Busse
+# zu beeinflussen. Er läuft in einer Schleife, bis das Flag `running` zurückgesetzt wird.
+#
+# Parameter:
+# - bus: Der RS485-Bus, den dieser Thread bedient.
+def read_ems(bus):
+
+    while running.is_set():
+    
+        try:
+        
+            bus.open()
+            
+            # Führt anstehende Schreibbefehle vor jeder Busabfrage aus. Überflüssige Befehle entfallen; das
+            # geschriebene Register wird nur zurückgelesen, wenn das Echo den Wert nicht bestätigt.
+            commands = take_commands(bus)
+            
+            for (device, register_address), (value, name) in commands.items():
+            
+                if write_is_redundant(device, register_address, value):
+                
+                    write_log("EMS %s - %s is already %s, write skipped", logging.INFO, device.nr, name, value)
+                    
+                    continue
+                
+                response_valid, echo_verified = write_ems(device, register_address, 0x0001, value)
+                
+                if not response_valid:
+                
+                    write_log("EMS %s - %s change failed", logging.ERROR, device.nr, name)
+                    
+                    continue
+                
+                if echo_verified:
+                
+                    write_confirmed(device, register_address, value)
+                    
+                else:
+                
+                    request_ems(device, register_address, 0x0001)
+                
+                write_log("EMS %s - %s changed successful", logging.INFO, device.nr, name)
+            
+            if commands:
+            
+                continue
+            
+            # Wählt den Registerblock mit der frühesten Frist über alle EMS.
+            device, block, delay = next_poll(bus)
+            
+            # Wartet bis zur Frist; neue Steuerbefehle oder das Beenden wecken den Thread vorzeitig auf.
+            if delay > 0:
+            
+                bus.wakeup.wait(delay)
+                bus.wakeup.clear()
+                
+                continue
+            
+            # Regelmäßige Leseanforderung an das EMS.
+            write_log("##################### - EMS %s - %s", logging.DEBUG, device.nr, block.name)
+            request_ems(device, block.register_address, block.register_count)
+            
+            # Ein EMS, das offline ist, wird über seine Prüfzeit statt über die Fristen eingeplant; eine
+            # fehlgeschlagene Abfrage bleibt fällig und wird nach der Wartezeit des EMS wiederholt.
+            if device.breaker.online is not False and not device.breaker.attempt:
+            
+                device.scheduler.complete(block, bus.stats.lost)
+            
+            # Berichtet regelmäßig die Busauslastung.
+            bus.stats.report(EMS_BUS_REPORT_INTERVAL)
+            
+        except (serial.SerialException, OSError) as e:
+        
+            # Nur dieser Bus ist betroffen; er wird später erneut geöffnet.
+            write_log("EMS - %s failed: %s", logging.ERROR, bus.port, e)
+            
+            bus.close()
+            bus.wakeup.wait(RS485_REOPEN_DELAY)
+            bus.wakeup.clear()
+
+# Thread zur Veröffentlichung von EMS-Daten
+# Dieser Thread wartet blockierend auf neue EMS-Daten in der Warteschlange, entnimmt anschließend alle
+# bereits vorhandenen Einträge (bis `MQTT_PUBLISH_BATCH_SIZE`) auf einmal, bereitet diese auf und
+# veröffentlicht sie, solange das Flag `running` gesetzt ist.
+def publish_ems():
+    
+    while running.is_set():
+    
+        # Wartet blockierend auf den ersten Eintrag; solange nachgesendet wird, ohne zu warten.
+        try:
+        
+            batch = [data_queue.get(timeout=0 if replay_pending() else MQTT_PUBLISH_WAIT_TIMEOUT)]
+            
+        except queue.Empty:
+        
+            batch = []
+        
+        # Entnimmt alle weiteren bereits vorhandenen Einträge ohne zu warten.
+        while len(batch) < MQTT_PUBLISH_BATCH_SIZE:
+        
+            try:
+            
+                batch.append(data_queue.get_nowait())
+                
+            except queue.Empty:
+            
+                break
+        
+        # Veröffentlicht die gesicherten Registerwerte, sobald der Broker verbunden ist.
+        if register_snapshot is not None and register_snapshot.values and mqtt_connected.is_set():
+        
+            for reading in register_snapshot.take():
+            
+                if spool is not None:
+                
+                    spool.supersede(reading)
+                
+                publish_reading(reading)
+        
+        for reading in batch:
+        
+            # Ein leerer Eintrag signalisiert das Beenden.
+            if reading is None or not running.is_set():
+            
+                return
+            
+            stage_timer.add_wall("queue_latency", reading.timestamp)
+            
+            if spool_reading(reading):
+            
+                continue
+            
+            publish_reading(reading)
+        
+        replay_spool()
+        
+        if register_snapshot is not None:
+        
+            register_snapshot.save_periodically(devices)
+        
+        data_queue.report(MQTT_QUEUE_REPORT_INTERVAL)
+        stage_timer.report(PROFILE_REPORT_INTERVAL)
+            
+# Funktion zur Veröffentlichung eines Registerblocks
+# Diese Funktion veröffentlicht den Block als ein JSON-Dokument oder jedes Register auf seinem eigenen Thema.
+# Nachgesendete Blöcke umgehen den Änderungsfilter, damit auch unveränderte Werte im Verlauf ankommen.
+#
+# Parameter:
+# - reading: Der gelesene Registerblock.
+# - replayed: True für einen Registerblock aus dem Zwischenspeicher.
+def publish_reading(reading, replayed=False):
+    
+    # Veröffentlicht den Block als ein JSON-Dokument.
+    if MQTT_PUBLISH_MODE == "json":
+    
+        ems_publish_state(reading, replayed)
+        
+        return
+    
+    # Bereitet die Registerwerte des Blocks auf und Veröffentlicht diese.
+    for register, parsed_value in convert_reading(reading):
+    
+        ems_publish_data(reading.device, register, parsed_value, replayed)
+
+# Funktion zum Nachsenden zwischengespeicherter Registerblöcke
+# Diese Funktion veröffentlicht höchstens `MQTT_PUBLISH_BATCH_SIZE` Registerblöcke aus dem Zwischenspeicher,
+# begrenzt auf `MQTT_SPOOL_REPLAY_RATE` Blöcke pro Sekunde. Sie kehrt zurück, sobald ein neuer Registerblock in der
+# Warteschlange liegt (damit er ohne Verzögerung veröffentlicht wird) oder die Verbindung verloren geht.
+def replay_spool():
+    
+    count = 0
+    
+    while count < MQTT_PUBLISH_BATCH_SIZE and replay_pending() and running.is_set():
+    
+        reading = spool.peek()
+        
+        # Alles nachgesendet: die währenddessen veröffentlichten Blöcke sind neuer und werden erneut veröffentlicht.
+        if reading is None:
+        
+            write_log("MQTT - Spool replayed completely, republishing %s current block(s)", logging.INFO, len(spool.superseded))
+            
+            for reading in spool.superseded.values():
+            
+                publish_reading(reading, replayed=True)
+            
+            spool.superseded.clear()
+            
+            break
+        
+        delay = replay_bucket.take()
+        
+        if delay > 0:
+        
+            time.sleep(delay)
+        
+        publish_reading(reading, replayed=True)
+        spool.consume()
+        
+        metrics.inc("ems_mqtt_replayed_total")
+        
+        count += 1
+        
+        if data_queue.entries:
+        
+            break
+
+# Thread zur Ausführung der MQTT-Ereignisschleife
+# Dieser Thread führt die Ereignisschleife des MQTT-Clients in regelmäßigen Abständen aus,
+# solange das Flag `running` gesetzt ist. Ist die Verbindung getrennt, wartet er mit `reconnect_delay()`
+# und versucht es erneut, bis der Broker wieder erreichbar ist.
+def mqtt_read_loop():
+
+    attempt = 0
+    
+    while running.is_set():
+    
+        if client.socket() is not None:
+        
+            if mqtt_connected.is_set():
+            
+                attempt = 0
+            
+            client.loop(timeout=1.0)
+            
+            continue
+        
+        mqtt_wakeup.wait(reconnect_delay(attempt))
+        
+        attempt += 1
+        
+        if running.is_set():
+        
+            mqtt_reconnect(attempt)
+
+################################################################################
+#                               Asyncio-Laufzeit                               #
+################################################################################
+# Alternative zu den Threads (RUNTIME_MODE = "asyncio"): Serielle Schnittstellen und MQTT-Socket werden in
+# einer Ereignisschleife überwacht. Abfragen, Steuerbefehle und Veröffentlichung laufen als Coroutinen,
+# die Wartezeiten auf Antworten werden von der Ereignisschleife exakt eingehalten.
+
+# Klasse zur Einbindung des MQTT-Clients in die asyncio-Ereignisschleife
+# Diese Klasse registriert den Socket des MQTT-Clients bei der Ereignisschleife, sodass Lesen und Schreiben
+# nur bei Bedarf erfolgen, und führt die regelmäßigen Aufgaben des Clients (Keepalive) als Coroutine aus.
+class AsyncioMqttHelper:
+
+    def __init__(self, loop, client):
+    
+        self.loop = loop
+        self.client = client
+        self.misc_task = None
+        
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+    
+    # Löst den Client von der Ereignisschleife, bevor diese geschlossen wird. Danach schreibt der Client wieder
+    # selbst, z.B. bei einem späteren client.disconnect().
+    def close(self):
+    
+        self.client.on_socket_open = None
+        self.client.on_socket_close = None
+        self.client.on_socket_register_write = None
+        self.client.on_socket_unregister_write = None
+        
+        if self.misc_task is not None:
+        
+            self.misc_task.cancel()
+    
+    def on_socket_open(self, client, userdata, sock):
+    
+        if self.loop.is_closed():
+        
+            return
+        
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+    
+    def on_socket_close(self, client, userdata, sock):
+    
+        if self.loop.is_closed():
+        
+            return
+        
+        self.loop.remove_reader(sock)
+        
+        if self.misc_task is not None:
+        
+            self.misc_task.cancel()
+    
+    def on_socket_register_write(self, client, userdata, sock):
+    
+        if not self.loop.is_closed():
+        
+            self.loop.add_writer(sock, client.loop_write)
+    
+    def on_socket_unregister_write(self, client, userdata, sock):
+    
+        if not self.loop.is_closed():
+        
+            self.loop.remove_writer(sock)
+    
+    async def misc_loop(self):
+    
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+        
+            await asyncio.sleep(1)
+
+# Funktion zum Öffnen eines Busses in der Ereignisschleife
+# Diese Funktion öffnet die serielle Schnittstelle nicht blockierend und registriert sie bei der Ereignisschleife.
+# Eintreffende Bytes werden direkt in den Rahmendecoder des Busses gelesen.
+#
+# Parameter:
+# - loop: Die laufende Ereignisschleife.
+# - bus: Der zu öffnende RS485-Bus.
+def open_bus_async(loop, bus):
+    
+    if bus.ser is None:
+    
+        bus.open()
+        bus.ser.timeout = 0
+        bus.error = None
         
-    else:
+        loop.add_reader(bus.ser.fileno(), on_serial_readable, loop, bus)
+
+# Funktion zum Schließen eines Busses in der Ereignisschleife
+#
+# Parameter:
+# - loop: Die laufende Ereignisschleife.
+# - bus: Der zu schließende RS485-Bus.
+def close_bus_async(loop, bus):
+    
+    if bus.ser is not None:
     
-        # Extrahiert die Registerwerte aus der Antwort.
-        for i in range(register_count):
+        try:
         
-            value = response[8 + i*2:10 + i*2]
-            value = int(value.hex(), 16)
+            loop.remove_reader(bus.ser.fileno())
             
-            register_values.append(value)
+        except (ValueError, OSError):
         
-        # Überprüft die CRC-Prüfsumme.
-        crc_received = struct.unpack('<H', response[-2:])[0]
-        crc_calculated = calculate_crc(response[:-2])
+            pass
+    
+    bus.close()
+
+# Funktion zum Lesen empfangener Bytes
+# Diese Funktion wird von der Ereignisschleife aufgerufen, sobald die serielle Schnittstelle lesbar ist.
+# Ein Fehler (z.B. abgezogener Adapter) wird am Bus vermerkt und beim nächsten Warten ausgelöst.
+#
+# Parameter:
+# - loop: Die laufende Ereignisschleife.
+# - bus: Der lesbare RS485-Bus.
+def on_serial_readable(loop, bus):
+    
+    try:
+    
+        bus.decoder.feed(bus.ser.read(bus.ser.in_waiting or 1))
         
-        if crc_received != crc_calculated:
+    except (serial.SerialException, OSError) as e:
+    
+        bus.error = e
         
-            response_valid = False
-            
-            write_log(f"EMS - Response frame: CRC is wrong!", logging.DEBUG)
+        loop.remove_reader(bus.ser.fileno())
     
-    # Gibt die Gültigkeit der Antwort und die Registerwerte zurück
-    return response_valid, register_values
+    bus.readable.set()
 
-# Funktion zur Interpretation und Umwandlung von EMS-Registerwerten
-# Diese Funktion interpretiert die Werte von EMS-Registern basierend auf deren Adressen und wandelt sie
-# in lesbare oder anderweitig nützliche Formate um.
+# Funktion zum Empfangen einer Antwort in der Ereignisschleife
+# Diese Funktion wartet höchstens `RS485_TIMEOUT` Sekunden auf einen Rahmen, dessen Basisrahmen mit der
+# gesendeten Nachricht übereinstimmt. Fremde Rahmen werden wie bei receive_response() übersprungen.
 #
 # Parameter:
-# - value_address: Die Adresse des Registers als Hexadezimalzeichenkette.
-# - value: Der Wert des Registers.
+# - bus: Der RS485-Bus, von dem gelesen wird.
+# - frame_base: Der Basisrahmen der gesendeten Nachricht.
 #
 # Rückgabewert:
-# - value_address: Die Adresse des Registers als Ganzzahl.
-# - parsed_value: Der interpretierte und umgewandelte Wert.
-def ems_parse_value(value_address, value):
+# - response: Der empfangene Antwortrahmen (leer, wenn keine gültige Antwort empfangen wurde).
+async def receive_response_async(bus, frame_base):
     
-    # Konvertiert die Adresse in eine Ganzzahl
-    value_address = int(value_address, 16)
-    parsed_value = None
+    deadline = time.monotonic() + RS485_TIMEOUT
+    started = time.perf_counter()
+    waiting_for_first_byte = True
     
-    # Interpretiert die Werte basierend auf der Adresse.
-    if value_address in [0x302D, 0x303B, 0x3039]:
+    while running.is_set():
     
-        if value == 1:
-        
-            parsed_value = "on" 
-        
-        else: 
+        if bus.error is not None:
         
-            parsed_value = "off"
-
-    elif value_address in [0x401C, 0x401A, 0x400E, 0x4010, 0x4001, 0x401E, 0x401F, 0x4002, 0x4005, 0x4018, 0x4017, 0x4020, 0x4021, 0x3027, 0x3029, 0x302A, 0x302C, 0x4023, 0x4024, 0x4025]:
-        
-        parsed_value = value / 10
-
-    elif value_address in [0x4003, 0x4006, 0x4019, 0x401B, 0x4026, 0x4027, 0x4028, 0x3028, 0x302B]:
+            raise bus.error
         
-        parsed_value = value / 100
-
-    elif value_address in [0x302E, 0x3072, 0x4004, 0x4007, 0x401D, 0x301F, 0x3022]:
+        # Erfasst wie receive_response() die Zeit bis zum ersten Byte der Antwort.
+        if waiting_for_first_byte and bus.decoder.buffer:
         
-        parsed_value = value / 1
-
-    elif value_address == 0x4029 or value_address == 0x402B or value_address == 0x402D or value_address == 0x403A:
+            stage_timer.add("first_byte", started)
+            
+            waiting_for_first_byte = False
         
-        if value >= 2**31:
+        frame = bus.decoder.next_frame()
         
-            value -= 2**32
+        while frame is not None:
         
-        parsed_value = value / 10
-
-    elif value_address == 0x4016 or value_address == 0x4042:
+            if logger.isEnabledFor(logging.DEBUG):
+            
+                write_log("EMS - Response frame: %s", logging.DEBUG, frame.hex())
+            
+            if frame[:8] == frame_base:
+            
+                stage_timer.add("frame_read", started)
+                
+                return frame
+            
+            metrics.inc("ems_header_mismatches_total")
+            
+            frame = bus.decoder.next_frame()
         
-        if value == 1:
+        remaining = deadline - time.monotonic()
         
-            parsed_value = "Online" 
+        if remaining <= 0:
         
-        else: 
+            break
         
-            parsed_value = "Offline"
-
-    elif value_address == 0x3020:
+        bus.readable.clear()
         
-        if value == 1:
+        try:
         
-            parsed_value = "Bleigel/Säure Batterie"
+            await asyncio.wait_for(bus.readable.wait(), remaining)
             
-        elif value == 2:
+        except asyncio.TimeoutError:
         
-            parsed_value = "LiFePo4 Batterie"
+            break
+    
+    return b""
 
-    elif value_address == 0x3021:
+# Funktion zum Übertragen eines Rahmens in der Ereignisschleife
+# Gegenstück zu transfer_frame() für die asyncio-Laufzeit.
+async def transfer_frame_async(bus, frame, frame_base):
     
-        if value == 0:
-        
-            parsed_value = "48V"
-            
-        elif value == 1:
+    started = time.monotonic()
+    
+    send_frame(bus, frame)
+    
+    response = await receive_response_async(bus, frame_base)
+    
+    bus.stats.add(time.monotonic() - started)
+    
+    return response
+
+# Gegenstück zu request_ems() für die asyncio-Laufzeit.
+async def request_ems_async(device, register_address, register_count):
+    
+    if not running.is_set():
+    
+        return False
+    
+    labels = request_labels(device, register_address)
+    
+    frame, frame_base = build_frame(device, 0x03, register_address, register_count)
+    
+    if device.breaker.attempt:
+    
+        metrics.inc("ems_request_retries_total", labels)
+    
+    started = time.monotonic()
+    
+    response = await transfer_frame_async(device.bus, frame, frame_base)
+    duration = time.monotonic() - started
+    
+    metrics.observe("ems_request_duration_seconds", labels, duration)
+    
+    if response and process_response(device, response, frame_base, register_address, register_count):
+    
+        device_succeeded(device)
         
-            parsed_value = "51.2V"
+        return True
+    
+    request_failed(device, duration)
+    
+    return False
 
-    elif value_address == 0x4022:
+# Gegenstück zu write_ems() für die asyncio-Laufzeit.
+async def write_ems_async(device, register_address, register_count, register_data):
+    
+    frame, frame_base = build_frame(device, 0x10, register_address, register_count, register_data)
     
-        if value == 1:
+    for attempt in range(device.breaker.attempts()):
+    
+        if not running.is_set():
         
-            parsed_value = "Online"
-            
-        elif value == 2:
+            return False, False
         
-            parsed_value = "Disabled"
-            
-        else:
+        response = await transfer_frame_async(device.bus, frame, frame_base)
+        response_valid, echo_verified = check_write_echo(response, frame)
         
-            parsed_value = "Offline"
-
-    else:
+        if response_valid:
+        
+            device_succeeded(device)
+            
+            return True, echo_verified
     
-        parsed_value = value
-
-    # Gibt die Adresse und den interpretierten Wert zurück
-    return value_address, parsed_value
-
-# Funktion zur Veröffentlichung von EMS-Daten auf MQTT-Themen
-# Diese Funktion veröffentlicht interpretierte EMS-Daten auf entsprechenden MQTT-Themen basierend auf der Registeradresse.
-#
-# Parameter:
-# - value_address: Die Adresse des Registers als Ganzzahl.
-# - parsed_value: Der interpretierte und umgewandelte Wert des Registers.
-def ems_publish_data(value_address,parsed_value):
-
-    topics = {
-        0x302D: "solar/ems/{}/EMS_Limit",
-        0x302E: "solar/ems/{}/EMS_Power_Limit",
-        0x4021: "solar/ems/{}/EMS_Load_Power",
-        0x303B: "solar/ems/{}/EMS_EM",
-        0x3039: "solar/ems/{}/EMS_Bypass",
-        0x4001: "solar/ems/{}/EMS_Temperature",
-        0x401F: "solar/ems/{}/EMS_Load_Energy",
-        0x3072: "solar/ems/{}/EMS_Address",
-        0x4002: "solar/ems/{}/MPPT1_Voltage",
-        0x4003: "solar/ems/{}/MPPT1_Current",
-        0x4004: "solar/ems/{}/MPPT1_Power",
-        0x400E: "solar/ems/{}/MPPT1_Energy",
-        0x4005: "solar/ems/{}/MPPT2_Voltage",
-        0x4006: "solar/ems/{}/MPPT2_Current",
-        0x4007: "solar/ems/{}/MPPT2_Power",
-        0x4010: "solar/ems/{}/MPPT2_Energy",
-        0x401E: "solar/ems/{}/MPPT_Total_Energy",
-        0x4016: "solar/ems/{}/Battery_Online",
-        0x4042: "solar/ems/{}/Battery_BMS_Online",
-        0x401D: "solar/ems/{}/Battery_SOC",
-        0x4018: "solar/ems/{}/Battery_Voltage",
-        0x401A: "solar/ems/{}/Battery_Charging_Power",
-        0x4019: "solar/ems/{}/Battery_Charging_Current",
-        0x401C: "solar/ems/{}/Battery_Discharging_Power",
-        0x401B: "solar/ems/{}/Battery_Discharging_Current",
-        0x4017: "solar/ems/{}/Battery_Temperature",
-        0x4020: "solar/ems/{}/Battery_Energy",
-        0x301F: "solar/ems/{}/Battery_BMS_Type",
-        0x3020: "solar/ems/{}/Battery_Type",
-        0x3021: "solar/ems/{}/Battery_Voltage_Type",
-        0x3022: "solar/ems/{}/Battery_Capacity",
-        0x3027: "solar/ems/{}/Battery_BMS_Max_Voltage",
-        0x3028: "solar/ems/{}/Battery_BMS_Max_Current",
-        0x3029: "solar/ems/{}/Battery_BMS_Min_Voltage",
-        0x302A: "solar/ems/{}/Battery_Max_Voltage",
-        0x302B: "solar/ems/{}/Battery_Max_Current",
-        0x302C: "solar/ems/{}/Battery_Min_Voltage",
-        0x4022: "solar/ems/{}/EM_Online",
-        0x4029: "solar/ems/{}/EM_A_Power",
-        0x4026: "solar/ems/{}/EM_A_Current",
-        0x4023: "solar/ems/{}/EM_A_Voltage",
-        0x402B: "solar/ems/{}/EM_B_Power",
-        0x4027: "solar/ems/{}/EM_B_Current",
-        0x4024: "solar/ems/{}/EM_B_Voltage",
-        0x402D: "solar/ems/{}/EM_C_Power",
-        0x4028: "solar/ems/{}/EM_C_Current",
-        0x4025: "solar/ems/{}/EM_C_Voltage",
-        0x403A: "solar/ems/{}/EM_Total_Power"
-    }
+    device_failed(device)
+    
+    return False, False
 
-    topic = topics.get(value_address, None)
+# Coroutine zur Überwachung und Steuerung von EMS-Registerwerten
+# Gegenstück zum Thread read_ems() für die asyncio-Laufzeit; je RS485-Adapter läuft eine Coroutine.
+async def read_ems_async(loop, bus):
     
-    if topic:
+    while running.is_set():
     
-        # Veröffentlicht die Daten auf dem entsprechenden MQTT-Thema.
-        result = client.publish(topic.format(EMS_Nr), parsed_value)
+        try:
         
-        write_log(f"MQTT - Published to {topic.format(EMS_Nr)}: {parsed_value}", logging.DEBUG)
+            open_bus_async(loop, bus)
             
-        # Wartezeit zwischen den Veröffentlichungen.
-        time.sleep(0.2)
-
-################################################################################
-#                                   Threads                                    #
-################################################################################
-
-# Thread zur Überwachung und Steuerung von EMS-Registerwerten
-# Dieser Thread überwacht den Status von EMS-Flags und führt entsprechende Schreib- und Leseoperationen auf EMS-Registern durch.
-# Er läuft in einer Schleife, bis das Flag `running` zurückgesetzt wird.
-def read_ems():
-    
-    global EMS_EM_FLG
-    global EMS_EM_Value
-    global EMS_Bypass_FLG
-    global EMS_Bypass_Value
-    global EMS_Power_Limit_FLG
-    global EMS_Power_Limit_Value
-       
-    sequence = 0
-    sequence_2 = 0
+            # Führt anstehende Schreibbefehle vor jeder Busabfrage aus (siehe read_ems()).
+            commands = take_commands(bus)
+            
+            for (device, register_address), (value, name) in commands.items():
+            
+                if write_is_redundant(device, register_address, value):
+                
+                    write_log("EMS %s - %s is already %s, write skipped", logging.INFO, device.nr, name, value)
+                    
+                    continue
+                
+                response_valid, echo_verified = await write_ems_async(device, register_address, 0x0001, value)
+                
+                if not response_valid:
+                
+                    write_log("EMS %s - %s change failed", logging.ERROR, device.nr, name)
+                    
+                    continue
+                
+                if echo_verified:
+                
+                    write_confirmed(device, register_address, value)
+                    
+                else:
+                
+                    await request_ems_async(device, register_address, 0x0001)
+                
+                write_log("EMS %s - %s changed successful", logging.INFO, device.nr, name)
+            
+            if commands:
+            
+                continue
+            
+            # Wählt den Registerblock mit der frühesten Frist über alle EMS.
+            device, block, delay = next_poll(bus)
+            
+            # Wartet bis zur Frist; neue Steuerbefehle oder das Beenden wecken die Coroutine vorzeitig auf.
+            if delay > 0:
+            
+                try:
+                
+                    await asyncio.wait_for(bus.wakeup.wait(), delay)
+                    
+                except asyncio.TimeoutError:
+                
+                    pass
+                
+                bus.wakeup.clear()
+                
+                continue
+            
+            write_log("##################### - EMS %s - %s", logging.DEBUG, device.nr, block.name)
+            await request_ems_async(device, block.register_address, block.register_count)
+            
+            if device.breaker.online is not False and not device.breaker.attempt:
+            
+                device.scheduler.complete(block, bus.stats.lost)
+            
+            bus.stats.report(EMS_BUS_REPORT_INTERVAL)
+            
+        except (serial.SerialException, OSError) as e:
+        
+            write_log("EMS - %s failed: %s", logging.ERROR, bus.port, e)
+            
+            close_bus_async(loop, bus)
+            
+            try:
+            
+                await asyncio.wait_for(bus.wakeup.wait(), RS485_REOPEN_DELAY)
+                
+            except asyncio.TimeoutError:
+            
+                pass
+            
+            bus.wakeup.clear()
+    
+    close_bus_async(loop, bus)
 
+# Coroutine zur Veröffentlichung von EMS-Daten
+# Gegenstück zum Thread publish_ems() für die asyncio-Laufzeit.
+async def publish_ems_async():
+    
     while running.is_set():
     
-        # Überprüft und schreibt den EMS_EM-Wert, wenn das Flag gesetzt ist.
-        if EMS_EM_FLG == True:
+        # Wartet auf den ersten Eintrag (solange nachgesendet wird, ohne zu warten) und entnimmt alle weiteren
+        # bereits vorhandenen Einträge.
+        if replay_pending():
         
-            write_ems(0x303B,0x0001,EMS_EM_Value)
+            batch = []
             
-            request_ems(0x302E,0x0014)
-            
-            EMS_EM_FLG = False
+        else:
         
-            write_log(f"EMS - EMS_EM changed changed successful", logging.INFO)
+            try:
+            
+                batch = [await data_queue.get_async()]
+                
+            except queue.Empty:
+            
+                batch = []
         
-        # Überprüft und schreibt den EMS_Bypass-Wert, wenn das Flag gesetzt ist.
-        elif EMS_Bypass_FLG == True:
+        while len(batch) < MQTT_PUBLISH_BATCH_SIZE:
         
-            write_ems(0x3039,0x0001,EMS_Bypass_Value)
+            try:
             
-            request_ems(0x302E,0x0014)
+                batch.append(data_queue.get_nowait())
+                
+            except queue.Empty:
             
-            EMS_Bypass_FLG = False
+                break
         
-            write_log(f"EMS - EMS_Bypass changed changed successful", logging.INFO)
+        if register_snapshot is not None and register_snapshot.values and mqtt_connected.is_set():
+        
+            for reading in register_snapshot.take():
+            
+                if spool is not None:
+                
+                    spool.supersede(reading)
+                
+                await publish_reading_async(reading)
         
-        # Überprüft und schreibt den EMS_Power_Limit-Wert, wenn das Flag gesetzt ist.
-        elif EMS_Power_Limit_FLG == True:
+        for reading in batch:
         
-            write_ems(0x302E,0x0001,EMS_Power_Limit_Value)
+            if reading is None or not running.is_set():
+            
+                return
+            
+            stage_timer.add_wall("queue_latency", reading.timestamp)
             
-            request_ems(0x302E,0x0014)
+            if spool_reading(reading):
             
-            EMS_Power_Limit_FLG = False
+                continue
+            
+            await publish_reading_async(reading)
         
-            write_log(f"EMS - EMS_Power_Limit changed successful", logging.INFO)
+        await replay_spool_async()
         
-        # Regelmäßige Leseanforderungen an das EMS.
-        # Temperatur und MPPT Informationen
-        write_log("##################### - Temperatur und MPPT Informationen", logging.DEBUG)
-        request_ems(0x4001,0x0014)
+        if register_snapshot is not None:
         
-        # Zyklische zusätzliche Leseanforderungen.
-        if sequence == 0:
-
-            # CT Informationen
-            write_log("##################### - CT Informationen", logging.DEBUG)
-            request_ems(0x4022,0x0014) 
+            register_snapshot.save_periodically(devices)
         
-        elif sequence == 1:
+        data_queue.report(MQTT_QUEUE_REPORT_INTERVAL)
+        stage_timer.report(PROFILE_REPORT_INTERVAL)
 
-            # Batterie & CT Informationen
-            write_log("##################### - Batterie & CT Informationen", logging.DEBUG)
-            request_ems(0x403A,0x0014)
-                 
-        elif sequence == 2:
-             
-            # Batterie & EMS Informationen
-            write_log("##################### - Batterie & EMS Informationen", logging.DEBUG)
-            request_ems(0x4016,0x0014)      
+# Gegenstück zu publish_reading() für die asyncio-Laufzeit.
+async def publish_reading_async(reading, replayed=False):
+    
+    if MQTT_PUBLISH_MODE == "json":
+    
+        now = time.monotonic()
         
-        elif sequence == 3:
-
-            if sequence_2 == 0:
-                
-                # Batterie Einstellungen
-                write_log("##################### - Batterie Einstellungen", logging.DEBUG)
-                request_ems(0x301F,0x0014) 
-                
-            elif sequence_2 == 1:
-                 
-                # EMS Einstellungen
-                write_log("##################### - EMS Einstellungen", logging.DEBUG)
-                request_ems(0x302D,0x0014) 
-
-            if sequence_2 == 1:
+        for block in replayed_documents(reading) if replayed else state_documents(reading, now):
         
-                sequence_2 = 0
+            delay = publish_bucket.take()
             
-            else:
+            if delay > 0:
+            
+                await asyncio.sleep(delay)
+            
+            mqtt_publish_state(reading.device, block, now, reading.timestamp if replayed else None)
         
-                sequence_2 += 1
+        return
+    
+    for register, parsed_value in convert_reading(reading):
+    
+        now = time.monotonic()
+        topic = reading.device.topics[register.address] if replayed else publish_topic(reading.device, register, parsed_value, now)
         
-        if sequence == 3:
+        if topic:
         
-            sequence = 0
+            delay = publish_bucket.take()
             
-        else:
+            if delay > 0:
+            
+                await asyncio.sleep(delay)
+            
+            mqtt_publish(topic, parsed_value, now)
+
+# Gegenstück zu replay_spool() für die asyncio-Laufzeit.
+async def replay_spool_async():
+    
+    count = 0
+    
+    while count < MQTT_PUBLISH_BATCH_SIZE and replay_pending() and running.is_set():
+    
+        reading = spool.peek()
+        
+        # Alles nachgesendet: die währenddessen veröffentlichten Blöcke sind neuer und werden erneut veröffentlicht.
+        if reading is None:
+        
+            write_log("MQTT - Spool replayed completely, republishing %s current block(s)", logging.INFO, len(spool.superseded))
+            
+            for reading in spool.superseded.values():
+            
+                await publish_reading_async(reading, replayed=True)
+            
+            spool.superseded.clear()
+            
+            break
+        
+        delay = replay_bucket.take()
+        
+        # Gibt der Ereignisschleife auch bei abgeschalteter Begrenzung Gelegenheit für die Abfragen.
+        await asyncio.sleep(delay)
+        
+        await publish_reading_async(reading, replayed=True)
+        spool.consume()
+        
+        metrics.inc("ems_mqtt_replayed_total")
+        
+        count += 1
+        
+        if data_queue.entries:
         
-            sequence += 1
+            break
 
-# Thread zur Veröffentlichung von EMS-Daten
-# Dieser Thread überwacht eine Warteschlange auf neue EMS-Daten, bereitet diese auf und veröffentlicht sie,
-# solange das Flag `running` gesetzt ist.
-def publish_ems():
+# Coroutine zur Wiederherstellung der MQTT-Verbindung
+# Gegenstück zum Wiederverbinden in mqtt_read_loop() für die asyncio-Laufzeit. Da client.reconnect() blockierend
+# verbindet, wird zuerst ohne Blockieren geprüft, ob der Broker Verbindungen annimmt; die Abfragen der EMS laufen
+# währenddessen weiter.
+async def mqtt_reconnect_async():
+    
+    attempt = 0
     
     while running.is_set():
     
-        # Überprüft, ob die Warteschlange nicht leer ist.
-        if not data_queue.empty():
+        if client.socket() is not None:
         
-            # Holt EMS-Daten aus der Warteschlange.
-            ems_data = data_queue.get()
+            if mqtt_connected.is_set():
             
-            # Bereitet die EMS-Daten auf und Veröffentlicht diese.
-            value_address, parsed_value = ems_parse_value(ems_data["value_address"],ems_data["value"])
-            ems_publish_data(value_address, parsed_value)
+                attempt = 0
             
-# Thread zur Ausführung der MQTT-Ereignisschleife
-# Dieser Thread führt die Ereignisschleife des MQTT-Clients in regelmäßigen Abständen aus,
-# solange das Flag `running` gesetzt ist.
-def mqtt_read_loop():
+            await asyncio.sleep(1)
+            
+            continue
+        
+        try:
+        
+            await asyncio.wait_for(mqtt_wakeup.wait(), reconnect_delay(attempt))
+            
+        except asyncio.TimeoutError:
+        
+            pass
+        
+        attempt += 1
+        
+        if not running.is_set():
+        
+            break
+        
+        # Wartet wie client.reconnect() höchstens 5 Sekunden auf den Verbindungsaufbau.
+        try:
+        
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(MQTT_BROKER, MQTT_PORT), 5)
+            writer.close()
+            
+        except (OSError, asyncio.TimeoutError) as e:
+        
+            write_log("MQTT - Broker %s:%s not reachable (attempt %s): %s", logging.WARNING, MQTT_BROKER, MQTT_PORT, attempt, e)
+            
+            continue
+        
+        mqtt_reconnect(attempt)
 
-    while running.is_set():
+# Coroutine zum Start der asyncio-Laufzeit
+# Diese Coroutine richtet Warteschlange, Ereignisse und MQTT-Client für die Ereignisschleife ein,
+# verbindet sich mit dem MQTT-Broker und führt alle Aufgaben bis zum Beenden aus.
+async def run_asyncio():
+    
+    global mqtt_wakeup
+    
+    loop = asyncio.get_running_loop()
+    
+    # Ereignisse gehören zur Ereignisschleife.
+    data_queue.event = asyncio.Event()
+    
+    for bus in buses:
+    
+        bus.wakeup = asyncio.Event()
+        bus.readable = asyncio.Event()
+        bus.error = None
+    
+    mqtt_wakeup = asyncio.Event()
+    
+    # Das Signal wird in der Ereignisschleife behandelt, damit sie sofort aufwacht.
+    loop.add_signal_handler(signal.SIGTERM, handle_sigterm)
+    
+    mqtt_helper = AsyncioMqttHelper(loop, client)
+    mqtt_connect()
+    
+    tasks = [loop.create_task(read_ems_async(loop, bus)) for bus in buses]
+    tasks.append(loop.create_task(publish_ems_async()))
+    tasks.append(loop.create_task(mqtt_reconnect_async()))
+    
+    try:
+    
+        await asyncio.gather(*tasks)
+        
+    finally:
+    
+        # Trennt die Verbindung, solange die Ereignisschleife noch läuft (auch bei Strg+C), und sendet die
+        # DISCONNECT-Nachricht sofort, da die Ereignisschleife danach keine Schreibvorgänge mehr ausführt.
+        client.disconnect()
+        client.loop_write()
+        
+        mqtt_helper.close()
+
+# Funktion zum Ausführen eines Schritts beim Beenden
+# Diese Funktion führt einen Aufräumschritt aus und protokolliert Fehler, damit die folgenden Schritte
+# (z.B. die Sicherung der Registerwerte und das Schreiben der restlichen Protokollnachrichten) trotzdem
+# ausgeführt werden.
+#
+# Parameter:
+# - name: Die Bezeichnung des Schritts für das Protokoll.
+# - function: Die auszuführende Funktion.
+# - args: Die Argumente der Funktion.
+def shutdown_step(name, function, *args):
+    
+    try:
+    
+        function(*args)
+        
+    except Exception as e:
     
-        client.loop(timeout=1.0) 
+        write_log("EMS - Shutdown step %s failed: %s", logging.ERROR, name, e)
 
 ################################################################################
 #                                 Hauptprogramm                                #
@@ -941,17 +3701,72 @@ def mqtt_read_loop():
 # Veröffentlichen von EMS-Daten. Es enthält Fehlerbehandlung und sorgt für eine ordnungsgemäße
 # Beendigung bei einem Abbruch durch den Benutzer.
 
+# Alles, was beim Beenden aufgeräumt wird, existiert auch dann, wenn der Start vorher fehlschlägt.
+buses = []
+threads = []
+client = None
+metrics_server = None
+spool = None
+register_snapshot = None
+log_listener = None
+
 try:
     
     # Threading Event
     running = threading.Event()
     running.set()
+    
+    # RS485-Busse und EMS konfigurieren (die Ports werden von den Lese-Threads geöffnet)
+    buses = [RS485Bus(port, device_list) for port, device_list in RS485_BUSES.items()]
+    devices = [device for bus in buses for device in bus.devices]
+    
+    # Warteschlange zum Veröffentlichungs-Thread konfigurieren
+    data_queue = CoalescingQueue()
+    
+    # Befehlswarteschlange konfigurieren
+    command_lock = threading.Lock()
+    pending_commands = {}
+    
+    # MQTT-Verbindungsstatus (der MQTT-Thread wartet auf mqtt_wakeup zwischen zwei Verbindungsversuchen)
+    mqtt_connected = threading.Event()
+    mqtt_wakeup = threading.Event()
+
+    # Logging konfigurieren (Schreiben in einem eigenen Thread)
+    log_listener = setup_logging()
+
+    write_log("EMS - Using %s CRC implementation", logging.DEBUG, CRC_IMPLEMENTATION)
+    
+    for register_address, register_count, period, name in EMS_POLL_PLAN:
+    
+        write_log("EMS - Poll plan: 0x%04X, %s register(s) every %ss (%s)", logging.INFO, register_address, register_count, period, name)
 
-    # Logging konfigurieren
-    logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format='%(message)s')
+    # Zwischenspeicher für Broker-Ausfälle konfigurieren (optional)
+    if MQTT_SPOOL_DIR:
+    
+        try:
+        
+            spool = MqttSpool(MQTT_SPOOL_DIR, MQTT_SPOOL_SEGMENT_SIZE, MQTT_SPOOL_MAX_SIZE, devices)
+            
+        except OSError as e:
+        
+            write_log("MQTT - Spool directory %s is not usable, spooling disabled: %s", logging.ERROR, MQTT_SPOOL_DIR, e)
+        
+        if spool is not None and spool.pending():
+        
+            write_log("MQTT - %s byte(s) left in the spool from the last run", logging.INFO, spool.size)
+
+    # Warmstart: gesicherte Registerwerte nach dem Verbinden veröffentlichen (optional)
+    if EMS_STATE_FILE:
+    
+        register_snapshot = RegisterSnapshot(EMS_STATE_FILE, EMS_STATE_SAVE_INTERVAL)
+        count = register_snapshot.load(devices)
+        
+        if count:
+        
+            write_log("EMS - Warm start: republishing %s register value(s) from %s once connected", logging.INFO, count, EMS_STATE_FILE)
 
-    # Serial konfigurieren
-    ser = serial.Serial(RS485_PORT, baudrate=RS485_BAUD_RATE, parity=RS485_PARITY, stopbits=RS485_STOPBITS, bytesize=RS485_BYTESIZE, timeout=1)
+    # Metrik-Server starten (optional)
+    metrics_server = start_metrics_server(METRICS_PORT) if METRICS_PORT else None
 
     # MQTT-Client konfigurieren
     client = mqtt.Client(f"EMS_{EMS_Nr}_Client")
@@ -961,26 +3776,38 @@ try:
     client.on_message = on_message
 
     client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    client.connect(MQTT_BROKER, MQTT_PORT)
+    client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+    client.max_queued_messages_set(MQTT_MAX_QUEUED)
+    publish_bucket = TokenBucket(MQTT_PUBLISH_RATE, MQTT_PUBLISH_BURST)
+    replay_bucket = TokenBucket(MQTT_SPOOL_REPLAY_RATE, 1)
     client.keep_alive = 120
-
-    # Response Queue konfigurieren
-    data_queue = queue.Queue()
     
-    # Erstellen und starten der Threads
-    read_ems_thread = threading.Thread(target=read_ems)
-    publish_ems_thread = threading.Thread(target=publish_ems)
-    mqtt_read_loop_thread = threading.Thread(target=mqtt_read_loop)
+    # Beenden durch systemd wie durch Strg+C
+    signal.signal(signal.SIGTERM, handle_sigterm)
     
-    # Threads starten
-    read_ems_thread.start()
-    publish_ems_thread.start()
-    mqtt_read_loop_thread.start()
+    if RUNTIME_MODE == "asyncio":
     
-    # Warten auf Thread Ende
-    read_ems_thread.join()
-    publish_ems_thread.join()
-    mqtt_read_loop_thread.join()
+        # Alle Aufgaben laufen als Coroutinen in einer Ereignisschleife.
+        run_profiled("asyncio", asyncio.run, run_asyncio())
+        
+    else:
+    
+        mqtt_connect()
+
+        # Erstellen der Threads (ein Lese-Thread je RS485-Adapter)
+        threads = [threading.Thread(target=run_profiled, args=(f"read_ems_{os.path.basename(bus.port)}", read_ems, bus), name=f"read_ems {bus.port}") for bus in buses]
+        threads.append(threading.Thread(target=run_profiled, args=("publish_ems", publish_ems)))
+        threads.append(threading.Thread(target=run_profiled, args=("mqtt_read_loop", mqtt_read_loop)))
+        
+        # Threads starten
+        for thread in threads:
+        
+            thread.start()
+        
+        # Warten auf Thread Ende
+        for thread in threads:
+        
+            thread.join()
     
 
 except KeyboardInterrupt:
@@ -988,13 +3815,36 @@ except KeyboardInterrupt:
     print("Beendet durch Benutzer")
     
     # Stoppt die Schleifen in den Threads
-    running.clear()  
+    stop_running()
     
-    read_ems_thread.join()
-    publish_ems_thread.join()
-    mqtt_read_loop_thread.join()
+    for thread in threads:
+    
+        thread.join()
     
 finally:
     
-    client.disconnect()
-    ser.close()
+    # Jeder Schritt wird auch ausgeführt, wenn ein vorheriger fehlschlägt.
+    if client is not None:
+    
+        shutdown_step("MQTT disconnect", client.disconnect)
+    
+    for bus in buses:
+    
+        shutdown_step(f"closing {bus.port}", bus.close)
+    
+    if metrics_server is not None:
+    
+        shutdown_step("metrics server", metrics_server.shutdown)
+    
+    if spool is not None:
+    
+        shutdown_step("closing the spool", spool.close)
+    
+    if register_snapshot is not None:
+    
+        shutdown_step("saving register values", register_snapshot.save, devices)
+    
+    # Schreibt die restlichen Protokollnachrichten.
+    if log_listener is not None:
+    
+        log_listener.stop()
@@ -0,0 +1,427 @@
+################################################################################
+#                        EMS Simulator für RS485 zu MQTT                       #
+#                               Autor: Patrick Völker                          #
+################################################################################
+# Software-Nachbildung eines oder mehrerer Tentek EMS. Der Simulator beantwortet das A5 5A Protokoll
+# (0x03 Lesen, 0x10 Schreiben) über ein Pseudo-Terminal oder einen TCP-Socket, sodass das Hauptprogramm
+# ohne Wechselrichter und RS485-Adapter getestet und vermessen werden kann.
+#
+# Beispiele:
+#   python3 ems_simulator.py --pty --link /tmp/ttyEMS
+#       -> RS485_PORT = "/tmp/ttyEMS"
+#   python3 ems_simulator.py --tcp 5020 --address 1 --address 2 --latency 0.03 --drop 0.01 --corrupt 0.01
+#       -> RS485_PORT = "socket://localhost:5020"
+import argparse
+import logging
+import math
+import os
+import random
+import select
+import socket
+import struct
+import time
+import tty
+
+################################################################################
+#                                   Variablen                                  #
+################################################################################
+# Rohwerte der Register (wie vom EMS gesendet, vor Teiler und Texten). Register mit 4 Byte sind
+# als Paar aus höherwertigem und niederwertigem Register eingetragen.
+EMS_REGISTER_VALUES = {
+    # EMS Einstellungen
+    0x302D: 1,      # EMS_Limit (on)
+    0x302E: 800,    # EMS_Power_Limit (W)
+    0x3039: 0,      # EMS_Bypass (off)
+    0x303B: 1,      # EMS_EM (on)
+    0x3072: 1,      # EMS_Address
+    # Batterie Einstellungen
+    0x301F: 1,      # Battery_BMS_Type
+    0x3020: 2,      # Battery_Type (LiFePo4)
+    0x3021: 1,      # Battery_Voltage_Type (51.2V)
+    0x3022: 100,    # Battery_Capacity (Ah)
+    0x3027: 576,    # Battery_BMS_Max_Voltage (57.6 V)
+    0x3028: 5000,   # Battery_BMS_Max_Current (50 A)
+    0x3029: 480,    # Battery_BMS_Min_Voltage (48.0 V)
+    0x302A: 568,    # Battery_Max_Voltage (56.8 V)
+    0x302B: 3000,   # Battery_Max_Current (30 A)
+    0x302C: 500,    # Battery_Min_Voltage (50.0 V)
+    # Temperatur und MPPT
+    0x4001: 352,    # EMS_Temperature (35.2 °C)
+    0x4002: 385,    # MPPT1_Voltage (38.5 V)
+    0x4003: 520,    # MPPT1_Current (5.2 A)
+    0x4004: 200,    # MPPT1_Power (W)
+    0x4005: 372,    # MPPT2_Voltage (37.2 V)
+    0x4006: 480,    # MPPT2_Current (4.8 A)
+    0x4007: 178,    # MPPT2_Power (W)
+    0x400E: 0,      # MPPT1_Energy (32 Bit, 0.1 kWh)
+    0x400F: 12345,
+    0x4010: 0,      # MPPT2_Energy (32 Bit, 0.1 kWh)
+    0x4011: 11876,
+    # Batterie & EMS
+    0x4016: 1,      # Battery_Online
+    0x4017: 241,    # Battery_Temperature (24.1 °C)
+    0x4018: 522,    # Battery_Voltage (52.2 V)
+    0x4019: 310,    # Battery_Charging_Current (3.1 A)
+    0x401A: 1620,   # Battery_Charging_Power (162.0 W)
+    0x401B: 0,      # Battery_Discharging_Current
+    0x401C: 0,      # Battery_Discharging_Power
+    0x401D: 76,     # Battery_SOC (%)
+    0x401E: 2422,   # MPPT_Total_Energy (0.1 kWh)
+    0x401F: 1830,   # EMS_Load_Energy (0.1 kWh)
+    0x4020: 910,    # Battery_Energy (0.1 kWh)
+    0x4021: 2160,   # EMS_Load_Power (216.0 W)
+    # CT
+    0x4022: 1,      # EM_Online
+    0x4023: 2301,   # EM_A_Voltage (230.1 V)
+    0x4024: 2312,   # EM_B_Voltage
+    0x4025: 2298,   # EM_C_Voltage
+    0x4026: 152,    # EM_A_Current (1.52 A)
+    0x4027: 87,     # EM_B_Current
+    0x4028: 43,     # EM_C_Current
+    0x4029: 0,      # EM_A_Power (32 Bit, vorzeichenbehaftet, 0.1 W)
+    0x402A: 3496,
+    0x402B: 0,      # EM_B_Power
+    0x402C: 1988,
+    0x402D: 0xFFFF, # EM_C_Power (-42.0 W)
+    0x402E: 0xFE5C,
+    0x403A: 0,      # EM_Total_Power (32 Bit, vorzeichenbehaftet, 0.1 W)
+    0x403B: 5064,
+    0x4042: 1,      # Battery_BMS_Online
+}
+
+# Register, deren Werte im Betrieb schwanken (Leistungen, Ströme), und die Stärke der Schwankung.
+EMS_FLUCTUATING_REGISTERS = (0x4003, 0x4004, 0x4006, 0x4007, 0x4019, 0x401A, 0x4021, 0x4026, 0x4027, 0x4028, 0x402A, 0x402C, 0x403B)
+EMS_FLUCTUATION = 0.05
+
+################################################################################
+#                                  Funktionen                                  #
+################################################################################
+
+# Funktion zur Berechnung der CRC-16 (Modbus) Prüfsumme
+#
+# Parameter:
+# - data: Die Daten, für die die Prüfsumme berechnet werden soll.
+#
+# Rückgabewert:
+# - crc: Die berechnete Prüfsumme.
+def calculate_crc(data):
+
+    crc = 0xFFFF
+    
+    for pos in data:
+        
+        crc ^= pos
+        
+        for i in range(8):
+            
+            if (crc & 0x0001) != 0:
+                crc >>= 1
+                crc ^= 0xA001
+            else:
+                crc >>= 1
+    
+    return crc
+
+# Klasse für ein simuliertes EMS
+# Diese Klasse enthält die Register eines EMS. Geschriebene Register behalten ihren Wert, schwankende
+# Register ändern sich bei jedem Lesen leicht um ihren Ausgangswert.
+class SimulatedEms:
+
+    def __init__(self, address):
+        
+        self.address = address
+        self.registers = dict(EMS_REGISTER_VALUES)
+        self.registers[0x3072] = address
+        self.started = time.monotonic()
+    
+    # Gibt die Werte von `register_count` Registern ab `register_address` zurück; unbekannte Register sind 0.
+    def read(self, register_address, register_count):
+        
+        # Langsame Tageskurve mit etwas Rauschen für Leistungen und Ströme.
+        level = 1 + EMS_FLUCTUATION * math.sin((time.monotonic() - self.started) / 30)
+        values = []
+        
+        for register in range(register_address, register_address + register_count):
+            
+            value = self.registers.get(register, 0)
+            
+            if register in EMS_FLUCTUATING_REGISTERS:
+                
+                value = min(int(value * level * random.uniform(1 - EMS_FLUCTUATION, 1 + EMS_FLUCTUATION)), 0xFFFF)
+            
+            values.append(value)
+        
+        return values
+    
+    # Schreibt Werte ab `register_address`.
+    def write(self, register_address, values):
+        
+        for i, value in enumerate(values):
+            
+            self.registers[register_address + i] = value
+
+# Klasse für den simulierten RS485-Bus
+# Diese Klasse sammelt empfangene Bytes, erkennt darin Anfragen und erstellt die Antworten der
+# angesprochenen EMS. Störungen (Verzögerung, Zeichenabstände, verlorene Rahmen, falsche CRC) werden
+# hier eingestreut.
+class SimulatedBus:
+
+    def __init__(self, devices, latency, jitter, drop, corrupt):
+        
+        self.devices = {device.address: device for device in devices}
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.corrupt = corrupt
+        self.buffer = bytearray()
+        self.stats = {"requests": 0, "dropped": 0, "corrupted": 0, "writes": 0, "invalid": 0}
+    
+    # Nimmt empfangene Bytes entgegen und gibt die fertigen Anfragen zurück.
+    def feed(self, data):
+        
+        self.buffer += data
+        requests = []
+        
+        while True:
+            
+            start = self.buffer.find(b"\xA5\x5A")
+            
+            if start < 0:
+                
+                del self.buffer[:-1]
+                
+                break
+            
+            del self.buffer[:start]
+            
+            if len(self.buffer) < 8:
+                
+                break
+            
+            function_code = self.buffer[3]
+            register_count = struct.unpack_from(">H", self.buffer, 6)[0]
+            length = 10 + 2 * register_count if function_code == 0x10 else 10
+            
+            if len(self.buffer) < length:
+                
+                break
+            
+            frame = bytes(self.buffer[:length])
+            
+            if struct.unpack_from("<H", frame, length - 2)[0] != calculate_crc(frame[:-2]):
+                
+                # Kein gültiger Rahmen: Startcode verwerfen und weitersuchen.
+                self.stats["invalid"] += 1
+                
+                del self.buffer[:2]
+                
+                continue
+            
+            del self.buffer[:length]
+            requests.append(frame)
+        
+        return requests
+    
+    # Erstellt die Antwort auf eine Anfrage (None, wenn keine Antwort gesendet wird).
+    def respond(self, frame):
+        
+        device = self.devices.get(frame[2])
+        function_code = frame[3]
+        register_address, register_count = struct.unpack_from(">HH", frame, 4)
+        
+        if device is None:
+            
+            return None
+        
+        self.stats["requests"] += 1
+        
+        if function_code == 0x03:
+            
+            response = frame[:8] + struct.pack(f">{register_count}H", *device.read(register_address, register_count))
+            response += struct.pack("<H", calculate_crc(response))
+        
+        elif function_code == 0x10:
+            
+            device.write(register_address, struct.unpack_from(f">{register_count}H", frame, 8))
+            
+            self.stats["writes"] += 1
+            
+            logging.info("EMS %s - Register 0x%04X written: %s", device.address, register_address, frame[8:-2].hex())
+            
+            # Das EMS sendet den Schreibrahmen als Bestätigung zurück.
+            response = frame
+        
+        else:
+            
+            return None
+        
+        if random.random() < self.drop:
+            
+            self.stats["dropped"] += 1
+            
+            return None
+        
+        if random.random() < self.corrupt:
+            
+            self.stats["corrupted"] += 1
+            
+            response = response[:-1] + bytes([response[-1] ^ 0xFF])
+        
+        return response
+    
+    # Sendet eine Antwort nach der eingestellten Verzögerung, bei gesetztem Zeichenabstand Byte für Byte.
+    def send(self, write, response):
+        
+        time.sleep(self.latency)
+        
+        if not self.jitter:
+            
+            write(response)
+            
+            return
+        
+        for i in range(len(response)):
+            
+            write(response[i:i + 1])
+            time.sleep(random.uniform(0, self.jitter))
+
+# Funktion zur Bedienung einer Verbindung
+# Diese Funktion liest Anfragen aus einem Dateideskriptor und beantwortet sie, bis die Gegenstelle
+# die Verbindung schließt.
+#
+# Parameter:
+# - bus: Der simulierte Bus.
+# - read: Funktion zum Lesen empfangener Bytes.
+# - write: Funktion zum Senden von Bytes.
+# - fileno: Der Dateideskriptor, auf dem gewartet wird.
+def serve(bus, read, write, fileno):
+
+    while True:
+        
+        select.select([fileno], [], [])
+        
+        try:
+            
+            data = read(256)
+        
+        except OSError:
+            
+            return
+        
+        if not data:
+            
+            return
+        
+        for frame in bus.feed(data):
+            
+            response = bus.respond(frame)
+            
+            if response is not None:
+                
+                bus.send(write, response)
+
+# Funktion zum Start über ein Pseudo-Terminal
+# Diese Funktion öffnet ein Pseudo-Terminal, dessen Gegenseite vom Hauptprogramm wie eine serielle
+# Schnittstelle geöffnet wird, und legt optional einen symbolischen Link darauf an.
+#
+# Parameter:
+# - bus: Der simulierte Bus.
+# - link: Pfad für den symbolischen Link oder None.
+def run_pty(bus, link):
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+    
+    if link:
+        
+        if os.path.lexists(link):
+            
+            os.remove(link)
+        
+        os.symlink(port, link)
+        port = link
+    
+    logging.info("Simulator - Serving on %s", port)
+    
+    try:
+        
+        # Das Pseudo-Terminal bleibt offen, auch wenn das Hauptprogramm neu startet.
+        while True:
+            
+            serve(bus, lambda size: os.read(master, size), lambda data: os.write(master, data), master)
+    
+    finally:
+        
+        if link:
+            
+            os.remove(link)
+
+# Funktion zum Start über einen TCP-Socket
+# Diese Funktion wartet auf TCP-Verbindungen (z.B. RS485_PORT = "socket://localhost:5020") und bedient
+# jeweils eine Verbindung.
+#
+# Parameter:
+# - bus: Der simulierte Bus.
+# - port: Der TCP-Port.
+def run_tcp(bus, port):
+
+    server = socket.create_server(("", port))
+    
+    logging.info("Simulator - Serving on socket://localhost:%s", port)
+    
+    while True:
+        
+        connection, peer = server.accept()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
+        logging.info("Simulator - Connection from %s:%s", *peer[:2])
+        
+        with connection:
+            
+            bus.buffer.clear()
+            
+            serve(bus, connection.recv, connection.sendall, connection.fileno())
+        
+        logging.info("Simulator - Connection closed")
+
+################################################################################
+#                                 Hauptprogramm                                #
+################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simulates Tentek EMS units speaking the A5 5A RS485 protocol.")
+    transport = parser.add_mutually_exclusive_group(required=True)
+    transport.add_argument("--pty", action="store_true", help="serve on a pseudo terminal")
+    transport.add_argument("--tcp", type=int, metavar="PORT", help="serve on a TCP port (socket://host:PORT)")
+    parser.add_argument("--link", help="symlink to the pseudo terminal, e.g. /tmp/ttyEMS")
+    parser.add_argument("--address", type=lambda value: int(value, 0), action="append", help="device address (repeatable, default 1)")
+    parser.add_argument("--latency", type=float, default=0.02, help="delay before each response in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random delay between response bytes in seconds")
+    parser.add_argument("--drop", type=float, default=0.0, help="probability that a response is not sent")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="probability that a response has a wrong CRC")
+    parser.add_argument("--seed", type=int, help="random seed for reproducible runs")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s: %(levelname)s: %(message)s")
+    
+    if args.seed is not None:
+        
+        random.seed(args.seed)
+    
+    bus = SimulatedBus([SimulatedEms(address) for address in args.address or [1]], args.latency, args.jitter, args.drop, args.corrupt)
+    
+    try:
+        
+        if args.pty:
+            
+            run_pty(bus, args.link)
+        
+        else:
+            
+            run_tcp(bus, args.tcp)
+    
+    except KeyboardInterrupt:
+        
+        logging.info("Simulator - Stopped: %s", ", ".join(f"{key} {value}" for key, value in bus.stats.items()))